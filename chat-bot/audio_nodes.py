@@ -0,0 +1,420 @@
+"""Hands the Music playback off to audio worker processes
+
+Each worker (`audio_worker.py`) holds the voice connections and players
+of some guilds, so encoding and sending audio can't stall the gateway
+loop. The gateway stays in the bot process: it joins the voice channel
+and passes the voice session to the worker picked for the guild, the
+one with the lowest load (playing streams plus connected guilds).
+
+`AUDIO_WORKERS` is the number of workers of the whole host. The shards
+of a bot process share one group of workers, sized after the share of
+the shards the process runs.
+
+Messages are JSON lines over the worker's stdin and stdout, every one
+has an `op` and most have a `guild`.
+
+Bot to worker:
+
+- `connect`: user_id, channel_id, session_id, token, endpoint
+- `disconnect`
+- `play`: starts `track` now
+- `queue`: `track` to start as soon as the current one ends, or null
+- `stop`: stops and forgets the queued track
+- `status`: the worker's guilds and streams
+
+A message with a `nonce` gets a `reply` with the same nonce, `ok` and a
+`result` or an `error`.
+
+Worker to bot:
+
+- `ready`, once started
+- `load`: streams and guilds, every few seconds
+- `status`: `state` of a guild, `playing` (with the url and the gap
+  since the last track in ms), `finished`, `error` or `disconnected`
+- `voice_state`: channel_id, self_mute and self_deaf to send on the
+  gateway
+
+A track has a `url` and either the `path` of cached Opus frames, or a
+`stream_url`, a `volume` and `passthrough`.
+
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+
+log = logging.getLogger('discord')
+
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS') or 0)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+							 'audio_worker.py')
+REQUEST_TIMEOUT = 15
+VOICE_TIMEOUT = 10
+FOLLOW_INTERVAL = 60
+RESTART_DELAY = 5
+
+
+class AudioNodeError(Exception):
+	pass
+
+
+class AudioNode():
+	"""A worker process and the guilds it plays for"""
+
+	def __init__(self, group, worker_id):
+		self.group = group
+		self.loop = group.loop
+		self.worker_id = worker_id
+		self.process = None
+		self.guilds = set()
+		self.streams = 0
+		self.nonce = 0
+		self.pending = {}
+
+	@property
+	def load(self):
+		return self.streams + len(self.guilds)
+
+	@property
+	def alive(self):
+		return self.process is not None and self.process.returncode is None
+
+	async def start(self):
+		self.process = await asyncio.create_subprocess_exec(
+			sys.executable, WORKER_SCRIPT, str(self.worker_id),
+			stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+			cwd=os.path.dirname(WORKER_SCRIPT), loop=self.loop
+		)
+		self.streams = 0
+		self.loop.create_task(self.read())
+
+	def send(self, message):
+		if not self.alive:
+			raise AudioNodeError('Audio worker {} is down'.format(
+				self.worker_id
+			))
+		self.process.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+
+	async def request(self, message, timeout=REQUEST_TIMEOUT):
+		self.nonce += 1
+		nonce = message['nonce'] = self.nonce
+		future = asyncio.Future(loop=self.loop)
+		self.pending[nonce] = future
+		try:
+			self.send(message)
+			return await asyncio.wait_for(future, timeout, loop=self.loop)
+		finally:
+			self.pending.pop(nonce, None)
+
+	def reply(self, message):
+		future = self.pending.get(message['nonce'])
+		if future is None or future.done():
+			return
+		if message['ok']:
+			future.set_result(message.get('result'))
+		else:
+			future.set_exception(AudioNodeError(message.get('error')))
+
+	async def read(self):
+		while True:
+			line = await self.process.stdout.readline()
+			if not line:
+				break
+			try:
+				message = json.loads(line.decode('utf-8'))
+			except ValueError:
+				continue
+
+			op = message.get('op')
+			if op == 'reply':
+				self.reply(message)
+			elif op == 'load':
+				self.streams = message['streams']
+			elif op == 'ready':
+				log.info('Audio worker {} ready'.format(self.worker_id))
+			else:
+				self.group.handle(self, message)
+
+		await self.process.wait()
+		for future in self.pending.values():
+			if not future.done():
+				future.set_exception(AudioNodeError('Audio worker exited'))
+		await self.group.lost(self)
+
+	def close(self):
+		if self.alive:
+			self.process.stdin.close()
+			self.process.terminate()
+
+
+class AudioNodeGroup():
+	"""The audio workers of a bot process, shared by its shards
+
+	Workers are started on the first connection, once every shard of the
+	process has joined: the process gets its shards' share of `workers`.
+	Messages about a guild go to the pool of the shard that placed it.
+
+	"""
+
+	def __init__(self, loop, workers=AUDIO_WORKERS):
+		self.loop = loop
+		self.workers = workers
+		self.nodes = []
+		self.pools = set()
+		self.shard_count = 1
+		# guild id -> AudioNodePool
+		self.guild_pools = {}
+		self.started = False
+		# Shared by the connections waiting for the workers to start
+		self.starting = None
+
+	def add(self, pool):
+		self.pools.add(pool)
+		self.shard_count = pool.RickBot.shard_count or 1
+
+	def remove(self, pool):
+		self.pools.discard(pool)
+		if not self.pools:
+			self.close()
+
+	async def start(self):
+		if self.starting is None:
+			self.started = True
+			self.starting = asyncio.ensure_future(self.start_nodes(),
+												  loop=self.loop)
+		await asyncio.shield(self.starting, loop=self.loop)
+
+	async def start_nodes(self):
+		count = max(1, round(self.workers * len(self.pools) /
+							 self.shard_count))
+		self.nodes = [AudioNode(self, i) for i in range(count)]
+		for node in self.nodes:
+			try:
+				await node.start()
+			except Exception as e:
+				log.info('Could not start audio worker {}'.format(
+					node.worker_id
+				))
+				log.info(e)
+
+	def pick(self):
+		"""The alive worker with the lowest load"""
+		nodes = [node for node in self.nodes if node.alive]
+		if not nodes:
+			raise AudioNodeError('No audio worker available')
+		return min(nodes, key=lambda node: node.load)
+
+	def handle(self, node, message):
+		pool = self.guild_pools.get(message.get('guild'))
+		if pool:
+			pool.handle(node, message)
+
+	async def lost(self, node):
+		log.info('Audio worker {} exited with {}'.format(
+			node.worker_id,
+			node.process.returncode
+		))
+		for guild_id in list(node.guilds):
+			pool = self.guild_pools.get(guild_id)
+			if pool:
+				await pool.lost(guild_id)
+			else:
+				node.guilds.discard(guild_id)
+
+		if not self.started:
+			return
+		await asyncio.sleep(RESTART_DELAY, loop=self.loop)
+		if self.started:
+			try:
+				await node.start()
+			except Exception as e:
+				log.info('Could not restart audio worker {}'.format(
+					node.worker_id
+				))
+				log.info(e)
+
+	def close(self):
+		self.started = False
+		if self.starting:
+			self.starting.cancel()
+		for node in self.nodes:
+			node.close()
+		groups.pop(self.loop, None)
+
+
+# loop -> AudioNodeGroup of the bot process
+groups = {}
+
+
+class AudioNodePool():
+	"""Places the guilds of a shard on audio workers and relays their
+	messages
+
+	`handler(guild_id, message)` is scheduled for every status message,
+	and with the `lost` state when a worker dies.
+
+	"""
+
+	def __init__(self, RickBot, handler):
+		self.RickBot = RickBot
+		self.loop = RickBot.loop
+		self.handler = handler
+		self.group = groups.get(self.loop)
+		if self.group is None:
+			self.group = groups[self.loop] = AudioNodeGroup(self.loop)
+		self.group.add(self)
+		self.guild_nodes = {}
+		self.followers = {}
+
+	def is_connected(self, guild_id):
+		return guild_id in self.guild_nodes
+
+	async def connect(self, channel):
+		"""Joins a voice channel and hands the session to a worker"""
+		await self.group.start()
+		server = channel.server
+		ws = self.RickBot.ws
+		if server.id in self.guild_nodes:
+			# The voice session stays the same when moving
+			await ws.voice_state(server.id, channel.id)
+			return
+
+		user_id = self.RickBot.user.id
+		state = ws.wait_for('VOICE_STATE_UPDATE',
+							lambda d: d.get('user_id') == user_id and
+							d.get('guild_id') == server.id)
+		voice_server = ws.wait_for('VOICE_SERVER_UPDATE',
+								   lambda d: d.get('guild_id') == server.id)
+		await ws.voice_state(server.id, channel.id)
+		try:
+			state = await asyncio.wait_for(state, VOICE_TIMEOUT,
+										   loop=self.loop)
+			data = await asyncio.wait_for(voice_server, VOICE_TIMEOUT,
+										  loop=self.loop)
+		except asyncio.TimeoutError:
+			await ws.voice_state(server.id, None, self_mute=True)
+			raise
+
+		session = {'guild' : server.id, 'user_id' : user_id,
+				   'channel_id' : channel.id,
+				   'session_id' : state['session_id']}
+		try:
+			node = self.group.pick()
+			# The worker's messages about the guild come back to this shard
+			self.group.guild_pools[server.id] = self
+			await node.request(dict(session, op='connect',
+									token=data['token'],
+									endpoint=data['endpoint']))
+		except Exception:
+			if self.group.guild_pools.get(server.id) is self:
+				del self.group.guild_pools[server.id]
+			await ws.voice_state(server.id, None, self_mute=True)
+			raise
+
+		self.guild_nodes[server.id] = node
+		node.guilds.add(server.id)
+		self.followers[server.id] = self.loop.create_task(
+			self.follow(session)
+		)
+
+	async def follow(self, session):
+		"""Passes the voice server changes of a guild to its worker"""
+		guild_id = session['guild']
+		while guild_id in self.guild_nodes:
+			future = self.RickBot.ws.wait_for(
+				'VOICE_SERVER_UPDATE',
+				lambda d: d.get('guild_id') == guild_id
+			)
+			try:
+				data = await asyncio.wait_for(future, FOLLOW_INTERVAL,
+											  loop=self.loop)
+			except asyncio.TimeoutError:
+				# Waits on the current websocket again, it may have changed
+				continue
+
+			node = self.guild_nodes.get(guild_id)
+			if node is None:
+				return
+			try:
+				await node.request(dict(session, op='connect',
+										token=data['token'],
+										endpoint=data['endpoint']))
+			except Exception as e:
+				log.info('Could not move the voice of {}'.format(guild_id))
+				log.info(e)
+
+	def forget(self, guild_id):
+		node = self.guild_nodes.pop(guild_id, None)
+		if node:
+			node.guilds.discard(guild_id)
+		if self.group.guild_pools.get(guild_id) is self:
+			del self.group.guild_pools[guild_id]
+		follower = self.followers.pop(guild_id, None)
+		if follower:
+			follower.cancel()
+		return node
+
+	async def disconnect(self, guild_id):
+		node = self.forget(guild_id)
+		if node and node.alive:
+			await node.request({'op' : 'disconnect', 'guild' : guild_id})
+		else:
+			await self.RickBot.ws.voice_state(guild_id, None, self_mute=True)
+
+	def send(self, guild_id, op, **kwargs):
+		node = self.guild_nodes.get(guild_id)
+		if node is None:
+			raise AudioNodeError('Not connected to {}'.format(guild_id))
+		kwargs.update(op=op, guild=guild_id)
+		node.send(kwargs)
+
+	def play(self, guild_id, track):
+		self.send(guild_id, 'play', track=track)
+
+	def queue(self, guild_id, track):
+		self.send(guild_id, 'queue', track=track)
+
+	def stop(self, guild_id):
+		self.send(guild_id, 'stop')
+
+	async def status(self):
+		statuses = []
+		for node in self.group.nodes:
+			try:
+				status = await node.request({'op' : 'status'})
+			except Exception as e:
+				status = {'error' : str(e)}
+			status['worker'] = node.worker_id
+			statuses.append(status)
+		return statuses
+
+	def handle(self, node, message):
+		guild_id = message.get('guild')
+		op = message.get('op')
+		if op == 'voice_state':
+			self.loop.create_task(self.RickBot.ws.voice_state(
+				guild_id, message['channel_id'],
+				self_mute=message['self_mute'],
+				self_deaf=message['self_deaf']
+			))
+		elif op == 'status':
+			if message['state'] == 'disconnected':
+				self.forget(guild_id)
+			self.loop.create_task(self.handler(guild_id, message))
+
+	async def lost(self, guild_id):
+		"""Leaves the voice channel of a guild whose worker died"""
+		self.forget(guild_id)
+		try:
+			await self.RickBot.ws.voice_state(guild_id, None, self_mute=True)
+		except Exception as e:
+			log.info(e)
+		self.loop.create_task(self.handler(guild_id, {'op' : 'status',
+													  'guild' : guild_id,
+													  'state' : 'lost'}))
+
+	def close(self):
+		for follower in self.followers.values():
+			follower.cancel()
+		self.group.remove(self)
@@ -0,0 +1,242 @@
+"""Audio worker process
+
+Runs the voice connections and the players of the guilds a bot process
+hands off to it, see `audio_nodes` for the protocol. Messages are read
+from stdin and written to stdout, logs go to stderr.
+
+	python audio_worker.py <worker_id>
+
+"""
+import sys
+import json
+import asyncio
+import logging
+
+import discord
+from discord.voice_client import VoiceClient
+
+from opus_cache import OpusFilePlayer
+from opus_stream import FFmpegOpusPlayer
+
+log = logging.getLogger('discord')
+
+LOAD_INTERVAL = 5
+BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 2'
+
+
+class MainWebSocket():
+	"""Stands for the gateway, which lives in the bot process
+
+	The VoiceClient only uses it to change its voice state.
+
+	"""
+
+	def __init__(self, worker):
+		self.worker = worker
+
+	async def voice_state(self, guild_id, channel_id, self_mute=False,
+						  self_deaf=False):
+		self.worker.send({'op' : 'voice_state', 'guild' : guild_id,
+						  'channel_id' : channel_id, 'self_mute' : self_mute,
+						  'self_deaf' : self_deaf})
+
+
+class AudioWorker():
+
+	def __init__(self, worker_id, loop):
+		self.worker_id = worker_id
+		self.loop = loop
+		self.main_ws = MainWebSocket(self)
+		self.voices = {}
+		self.players = {}
+		# guild id -> track to start when the current one ends
+		self.queued = {}
+		# guild id -> loop time the last player finished at
+		self.finished_at = {}
+
+	def send(self, message):
+		sys.stdout.write(json.dumps(message) + '\n')
+		sys.stdout.flush()
+
+	def status(self, guild_id, state, **kwargs):
+		kwargs.update(op='status', guild=guild_id, state=state)
+		self.send(kwargs)
+
+	@property
+	def streams(self):
+		return sum(1 for player in self.players.values()
+				   if player.is_playing())
+
+	def create_player(self, guild_id, voice, track):
+		after = self.after(guild_id)
+		if track.get('path'):
+			return OpusFilePlayer(track['path'], voice, after=after)
+		return FFmpegOpusPlayer(voice, track['stream_url'],
+								volume=track.get('volume', 1.0),
+								passthrough=track.get('passthrough', False),
+								before_options=BEFORE_OPTIONS, after=after)
+
+	def after(self, guild_id):
+		def n(player):
+			# Called from the player's thread
+			self.loop.call_soon_threadsafe(self.finished, guild_id, player)
+		return n
+
+	def finished(self, guild_id, player):
+		if self.players.get(guild_id) is not player:
+			return
+		del self.players[guild_id]
+
+		if player.error:
+			log.info('Error from the player of {}'.format(guild_id))
+			log.info(player.error)
+
+		self.finished_at[guild_id] = self.loop.time()
+		track = self.queued.pop(guild_id, None)
+		if track:
+			self.start(guild_id, track)
+		else:
+			self.status(guild_id, 'finished')
+
+	def start(self, guild_id, track):
+		voice = self.voices.get(guild_id)
+		if not voice or not voice.is_connected():
+			self.status(guild_id, 'disconnected')
+			return
+
+		self.stop_player(guild_id)
+		try:
+			player = self.create_player(guild_id, voice, track)
+		except Exception as e:
+			log.info('Could not play {}'.format(track['url']))
+			log.info(e)
+			self.status(guild_id, 'error', url=track['url'], error=str(e))
+			return
+
+		self.players[guild_id] = player
+		player.start()
+
+		gap = None
+		finished_at = self.finished_at.pop(guild_id, None)
+		if finished_at is not None:
+			gap = (self.loop.time() - finished_at) * 1000
+		self.status(guild_id, 'playing', url=track['url'], gap=gap)
+
+	def stop_player(self, guild_id):
+		player = self.players.pop(guild_id, None)
+		if player:
+			player.stop()
+
+	async def op_connect(self, message):
+		guild_id = message['guild']
+		voice = self.voices.pop(guild_id, None)
+		if voice:
+			# New voice server, disconnect() would leave the channel
+			self.stop_player(guild_id)
+			voice._connected.clear()
+			voice.socket.close()
+			await voice.ws.close()
+
+		voice = VoiceClient(user=discord.Object(id=message['user_id']),
+							main_ws=self.main_ws,
+							session_id=message['session_id'],
+							channel=discord.Object(id=message['channel_id']),
+							data={'token' : message['token'],
+								  'guild_id' : guild_id,
+								  'endpoint' : message['endpoint']},
+							loop=self.loop)
+		await voice.connect()
+		self.voices[guild_id] = voice
+		return {'connected' : True}
+
+	async def op_disconnect(self, message):
+		guild_id = message['guild']
+		self.queued.pop(guild_id, None)
+		self.stop_player(guild_id)
+		voice = self.voices.pop(guild_id, None)
+		if voice:
+			await voice.disconnect()
+
+	async def op_play(self, message):
+		# A new song isn't the continuation of the last one, and the queued
+		# song is sent again once the queue is known
+		self.finished_at.pop(message['guild'], None)
+		self.queued.pop(message['guild'], None)
+		self.start(message['guild'], message['track'])
+
+	async def op_queue(self, message):
+		if message.get('track'):
+			self.queued[message['guild']] = message['track']
+		else:
+			self.queued.pop(message['guild'], None)
+
+	async def op_stop(self, message):
+		self.queued.pop(message['guild'], None)
+		self.stop_player(message['guild'])
+
+	async def op_status(self, message):
+		return {
+			'streams' : self.streams,
+			'guilds' : {guild_id : {
+				'playing' : guild_id in self.players,
+				'queued' : guild_id in self.queued
+			} for guild_id in self.voices}
+		}
+
+	async def handle(self, message):
+		handler = getattr(self, 'op_' + message['op'], None)
+		try:
+			if handler is None:
+				raise ValueError('Unknown op {}'.format(message['op']))
+			result = await handler(message)
+			reply = {'ok' : True, 'result' : result}
+		except Exception as e:
+			log.info('An error occured while handling {}'.format(message['op']))
+			log.info(e)
+			reply = {'ok' : False, 'error' : str(e)}
+
+		if 'nonce' in message:
+			reply.update(op='reply', nonce=message['nonce'])
+			self.send(reply)
+
+	async def report_load(self):
+		while True:
+			self.send({'op' : 'load', 'streams' : self.streams,
+					   'guilds' : len(self.voices)})
+			await asyncio.sleep(LOAD_INTERVAL)
+
+	async def run(self):
+		reader = asyncio.StreamReader(loop=self.loop)
+		protocol = asyncio.StreamReaderProtocol(reader, loop=self.loop)
+		await self.loop.connect_read_pipe(lambda: protocol, sys.stdin)
+
+		self.loop.create_task(self.report_load())
+		self.send({'op' : 'ready', 'worker' : self.worker_id})
+		while True:
+			line = await reader.readline()
+			# The bot process is gone
+			if not line:
+				break
+			try:
+				message = json.loads(line.decode('utf-8'))
+			except ValueError:
+				continue
+			self.loop.create_task(self.handle(message))
+
+		for guild_id in list(self.voices):
+			await self.op_disconnect({'guild' : guild_id})
+
+
+if __name__ == '__main__':
+	from sys import platform
+
+	logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+	if not discord.opus.is_loaded():
+		if platform == "linux" or platform == "linux2":
+			discord.opus.load_opus('./libopus.so')
+		elif platform == "darwin":
+			discord.opus.load_opus('libopus.dylib')
+
+	loop = asyncio.get_event_loop()
+	worker = AudioWorker(int(sys.argv[1]) if len(sys.argv) > 1 else 0, loop)
+	loop.run_until_complete(worker.run())
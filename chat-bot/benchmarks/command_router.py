@@ -0,0 +1,89 @@
+"""Messages/sec of the command router against running every command regex
+
+Run from the chat-bot directory:
+
+	python benchmarks/command_router.py
+
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import CommandRouter
+
+MESSAGES = 20000
+
+
+class FakeCommand():
+
+	def __init__(self, pattern):
+		self._pattern = pattern
+		self.prog = re.compile(pattern)
+
+	def __call__(self, content):
+		return self.prog.match(content)
+
+
+def make_commands(n):
+	commands = []
+	for i in range(n):
+		kind = i % 4
+		if kind == 0:
+			pattern = '^!cmd{}$'.format(i)
+		elif kind == 1:
+			pattern = '^!cmd{} ([0-9]*)$'.format(i)
+		elif kind == 2:
+			pattern = '^!cmd{} <@!?([0-9]*)>$'.format(i)
+		else:
+			pattern = '!cmd{}'.format(i)
+		commands.append(FakeCommand(pattern))
+	return commands
+
+
+def make_messages(n_commands):
+	rand = random.Random(42)
+	messages = []
+	for i in range(MESSAGES):
+		# Roughly 1 message out of 20 is a command
+		if i % 20 == 0:
+			messages.append('!cmd{} 12'.format(rand.randrange(n_commands)))
+		else:
+			messages.append('just chatting about things number {}'.format(i))
+	return messages
+
+
+def bench_naive(commands, messages):
+	start = time.perf_counter()
+	for content in messages:
+		for command in commands:
+			command(content)
+	return len(messages) / (time.perf_counter() - start)
+
+
+def bench_router(commands, messages):
+	router = CommandRouter(commands)
+	start = time.perf_counter()
+	for content in messages:
+		for command in router.match(content):
+			command(content)
+	return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+	print('{:>9} {:>15} {:>15} {:>8}'.format('commands', 'naive msg/s',
+											 'router msg/s', 'speedup'))
+	for n in (50, 200, 1000):
+		commands = make_commands(n)
+		messages = make_messages(n)
+		naive = bench_naive(commands, messages)
+		routed = bench_router(commands, messages)
+		print('{:>9} {:>15,.0f} {:>15,.0f} {:>7.1f}x'.format(n, naive, routed,
+															 routed / naive))
+
+
+if __name__ == '__main__':
+	main()
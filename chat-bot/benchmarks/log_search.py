@@ -0,0 +1,97 @@
+"""Search index over a synthetic million-message server
+
+Run from the chat-bot directory:
+
+	python benchmarks/log_search.py [messages]
+
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_search import GuildIndex, journal_entry
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+VOCABULARY = 50000
+AUTHORS = 2000
+QUERIES = [
+	'word1',
+	'word10 word20',
+	'word3000',
+	'word5 word50 word500',
+	'author:user42',
+	'author:user42 word1',
+	'word49999',
+]
+
+
+def make_journal(path):
+	rand = random.Random(42)
+	# Zipf-ish word frequencies
+	weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+	words = ['word{}'.format(rank) for rank in range(VOCABULARY)]
+	start = time.time() - MESSAGES
+	with open(path, 'w') as journal:
+		for i in range(0, MESSAGES, 1000):
+			batch = rand.choices(words, weights, k=12 * 1000)
+			for j in range(min(1000, MESSAGES - i)):
+				author = rand.randrange(AUTHORS)
+				timestamp = start + i + j
+				message = {
+					'id' : str(i + j),
+					'timestamp' : timestamp,
+					'channel' : 'general',
+					'content' : ' '.join(batch[j * 12:(j + 1) * 12]),
+					'author' : {'id' : str(author),
+								'name' : 'user{}'.format(author)}
+				}
+				entry = journal_entry(message, '2017-01-01')
+				journal.write(json.dumps(entry))
+				journal.write('\n')
+
+
+def main():
+	index_dir = tempfile.mkdtemp()
+	path = os.path.join(index_dir, '1.journal')
+
+	start = time.perf_counter()
+	make_journal(path)
+	duration = time.perf_counter() - start
+	print('Wrote {:,} journal entries in {:.1f}s ({:,.0f} msg/s)'.format(
+		MESSAGES, duration, MESSAGES / duration))
+
+	index = GuildIndex(index_dir, 1)
+	start = time.perf_counter()
+	index.refresh()
+	duration = time.perf_counter() - start
+	print('Loaded {:,} messages, {:,} terms in {:.1f}s ({:,.0f} msg/s)'.format(
+		len(index), len(index.postings), duration, len(index) / duration))
+
+	start = time.perf_counter()
+	index.save()
+	duration = time.perf_counter() - start
+	print('Saved the postings in {:.1f}s'.format(duration))
+
+	index = GuildIndex(index_dir, 1)
+	start = time.perf_counter()
+	index.load()
+	index.refresh()
+	duration = time.perf_counter() - start
+	print('Loaded {:,} messages from the postings in {:.1f}s'.format(
+		len(index), duration))
+
+	for query in QUERIES:
+		start = time.perf_counter()
+		result = index.search(query, page=0, per_page=20)
+		duration = time.perf_counter() - start
+		print('{:>24} : {:>9,} matches, first page in {:7.1f}ms'.format(
+			query, result['total'], duration * 1000))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,112 @@
+"""CPU used per stream by the playback modes of the Music plugin
+
+Every mode runs STREAMS concurrent streams of the same minute of Opus
+WebM audio as fast as possible, without sending anything:
+
+- pcm: discord.py's way, ffmpeg decodes to PCM, the volume is applied
+  with audioop and the frames are encoded with libopus in the bot process
+- ffmpeg: ffmpeg applies the volume and encodes, the bot demuxes Ogg
+- passthrough: ffmpeg copies the Opus audio, the bot demuxes Ogg
+
+The CPU time of the bot process and of ffmpeg, divided by the seconds of
+audio, is the share of a core a real time stream uses.
+
+Needs ffmpeg and libopus. Run from the chat-bot directory:
+
+	python benchmarks/playback.py
+
+"""
+import os
+import sys
+import audioop
+import resource
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from opus_stream import ffmpeg_args, read_packets
+
+STREAMS = 8
+DURATION = 60
+VOLUME = 0.6
+FRAME_SIZE = 3840
+SAMPLES_PER_FRAME = 960
+
+if not discord.opus.is_loaded():
+	discord.opus.load_opus('./libopus.so' if sys.platform.startswith('linux')
+						   else 'libopus.dylib')
+
+
+def make_source(directory):
+	path = os.path.join(directory, 'source.webm')
+	subprocess.check_call([
+		'ffmpeg', '-f', 'lavfi', '-i',
+		'sine=frequency=440:duration={}'.format(DURATION),
+		'-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k',
+		'-loglevel', 'error', '-y', path
+	])
+	return path
+
+
+def pcm_stream(source, volume):
+	encoder = discord.opus.Encoder(48000, 2)
+	process = subprocess.Popen(['ffmpeg', '-i', source, '-f', 's16le',
+								'-ar', '48000', '-ac', '2',
+								'-loglevel', 'warning', 'pipe:1'],
+							   stdout=subprocess.PIPE)
+	while True:
+		data = process.stdout.read(FRAME_SIZE)
+		if len(data) != FRAME_SIZE:
+			break
+		if volume != 1.0:
+			data = audioop.mul(data, 2, min(volume, 2.0))
+		encoder.encode(data, SAMPLES_PER_FRAME)
+	process.communicate()
+
+
+def opus_stream(source, volume, passthrough=False):
+	process = subprocess.Popen(ffmpeg_args(source, volume, passthrough),
+							   stdout=subprocess.PIPE)
+	for packet in read_packets(process.stdout):
+		pass
+	process.communicate()
+
+
+def run(name, target, *args):
+	self_before = resource.getrusage(resource.RUSAGE_SELF)
+	children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+	threads = [threading.Thread(target=target, args=args)
+			   for _ in range(STREAMS)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	self_after = resource.getrusage(resource.RUSAGE_SELF)
+	children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+	bot = (self_after.ru_utime + self_after.ru_stime -
+		   self_before.ru_utime - self_before.ru_stime)
+	ffmpeg = (children_after.ru_utime + children_after.ru_stime -
+			  children_before.ru_utime - children_before.ru_stime)
+	audio = STREAMS * DURATION
+	print('{:>18} : bot {:5.2f}% ffmpeg {:5.2f}% total {:5.2f}% '
+		  'of a core per stream'.format(name, bot / audio * 100,
+										ffmpeg / audio * 100,
+										(bot + ffmpeg) / audio * 100))
+
+
+def main():
+	with tempfile.TemporaryDirectory() as directory:
+		source = make_source(directory)
+		run('pcm', pcm_stream, source, VOLUME)
+		run('pcm (volume 1.0)', pcm_stream, source, 1.0)
+		run('ffmpeg', opus_stream, source, VOLUME)
+		run('passthrough', opus_stream, source, 1.0, True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,91 @@
+"""Purges 1000 messages from a fake channel history
+
+The fake HTTP client answers like Discord's history and bulk delete
+routes, with a fixed latency per request and a rate limit on deletes
+(requests over the limit wait, like discord.py does on a 429).
+
+Run from the chat-bot directory:
+
+	python benchmarks/purge.py
+
+"""
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from purge import Purger, snowflake_at
+
+LATENCY = 0.1
+DELETES_PER_SECOND = 5
+HISTORY = 5000
+AUTHORS = 4
+
+
+class FakeHTTP():
+
+	def __init__(self):
+		now = time.time()
+		# Oldest first, one message every 5 minutes, some older than 14 days
+		self.messages = [{
+			'id' : str(snowflake_at(now - (HISTORY - i) * 300) + i),
+			'author' : {'id' : str(i % AUTHORS)}
+		} for i in range(HISTORY)]
+		self.requests = 0
+		self.deletes = []
+
+	async def request(self):
+		self.requests += 1
+		await asyncio.sleep(LATENCY)
+
+	async def logs_from(self, channel_id, limit, before=None, after=None):
+		await self.request()
+		messages = [m for m in self.messages
+					if (before is None or int(m['id']) < int(before)) and
+					(after is None or int(m['id']) > int(after))]
+		if after is not None:
+			page = messages[:limit]
+		else:
+			page = messages[-limit:]
+		return list(reversed(page))
+
+	async def rate_limit(self):
+		now = time.time()
+		self.deletes = [t for t in self.deletes if now - t < 1]
+		while len(self.deletes) >= DELETES_PER_SECOND:
+			await asyncio.sleep(1 - (now - self.deletes[0]))
+			now = time.time()
+			self.deletes = [t for t in self.deletes if now - t < 1]
+		self.deletes.append(now)
+
+	async def delete_messages(self, channel_id, message_ids, guild_id):
+		assert 2 <= len(message_ids) <= 100
+		await self.rate_limit()
+		await self.request()
+		ids = set(message_ids)
+		self.messages = [m for m in self.messages if m['id'] not in ids]
+
+	async def delete_message(self, channel_id, message_id, guild_id):
+		await self.delete_messages(channel_id, [message_id, message_id],
+								   guild_id)
+
+
+async def run(name, **kwargs):
+	http = FakeHTTP()
+	purger = Purger(http)
+	start = time.perf_counter()
+	deleted = await purger.purge('1', '1', **kwargs)
+	duration = time.perf_counter() - start
+	print('{:>14} : deleted {:>5} messages in {:.2f}s ({} requests)'.format(
+		name, deleted, duration, http.requests))
+
+
+async def main():
+	await run('!clear 1000', limit=1000)
+	await run('!clear @user', check=lambda m: m['author']['id'] == '1')
+
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,235 @@
+"""Launches RickBot shards across processes and supervises them
+
+Every process runs `SHARDS_PER_PROCESS` shards on its own event loop. The
+supervisor watches the `RickBot.gateway.{shard_id}-{shard_count}` keys
+written by `RickBot.ping` and restarts the processes whose shards stopped
+beating, with an exponential backoff. Logins are staggered so that no
+more than one shard identifies every `IDENTIFY_INTERVAL` seconds.
+
+The shard count is `SHARD_COUNT`, or the one Discord recommends for the
+bot. Only the number of processes depends on the host's cores. SIGTERM
+closes the bots cleanly, so the plugins can flush what they buffer.
+
+"""
+import os
+import math
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+import aiohttp
+import aioredis
+from utils import parse_redis_url
+
+log = logging.getLogger('discord')
+
+TOKEN = os.getenv('RICKBOT_TOKEN')
+REDIS_URL = os.getenv('REDIS_URL')
+MONGO_URL = os.getenv('MONGO_URL')
+DD_AGENT_URL = os.getenv('DD_AGENT_URL')
+SENTRY_DSN = os.getenv('SENTRY_DSN')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or 0)
+SHARDS_PER_PROCESS = int(os.getenv('SHARDS_PER_PROCESS') or 0)
+GATEWAY_BOT_URL = 'https://discordapp.com/api/v6/gateway/bot'
+
+IDENTIFY_INTERVAL = 5.5
+CHECK_INTERVAL = 5
+STARTUP_GRACE = 120
+HEALTHY_RESET = 300
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+STOP_TIMEOUT = 30
+
+
+async def recommended_shard_count(loop):
+	headers = {'Authorization' : 'Bot ' + TOKEN}
+	with aiohttp.ClientSession(loop=loop) as session:
+		async with session.get(GATEWAY_BOT_URL, headers=headers) as resp:
+			resp.raise_for_status()
+			data = await resp.json()
+	return data['shards']
+
+
+def run_shards(shard_ids, shard_count):
+	"""Runs some shards in the current process, one identify at a time"""
+	from rickbot import RickBot
+
+	logging.basicConfig(level=logging.INFO)
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	async def start(bot, delay):
+		await asyncio.sleep(delay, loop=loop)
+		await bot.start(TOKEN)
+
+	bots = []
+	for shard_id in shard_ids:
+		bots.append(RickBot(shard_id=shard_id, shard_count=shard_count,
+							loop=loop, redis_url=REDIS_URL,
+							mongo_url=MONGO_URL, dd_agent_url=DD_AGENT_URL,
+							sentry_dsn=SENTRY_DSN))
+	main = asyncio.gather(*[start(bot, i * IDENTIFY_INTERVAL)
+							for i, bot in enumerate(bots)], loop=loop)
+
+	async def shutdown():
+		log.info('Closing shards {}'.format(shard_ids))
+		await asyncio.gather(*[bot.close() for bot in bots],
+							 return_exceptions=True, loop=loop)
+		main.cancel()
+
+	loop.add_signal_handler(signal.SIGTERM,
+							lambda: loop.create_task(shutdown()))
+	try:
+		loop.run_until_complete(main)
+	except asyncio.CancelledError:
+		pass
+
+
+class ShardGroup():
+	"""A process running a fixed set of shards"""
+
+	def __init__(self, shard_ids, shard_count):
+		self.shard_ids = shard_ids
+		self.shard_count = shard_count
+		self.process = None
+		self.started_at = 0
+		self.failures = 0
+		self.restart_at = 0
+		# Stops the failed process in the background
+		self.stopping = None
+
+	@property
+	def keys(self):
+		return ['RickBot.gateway.{}-{}'.format(shard_id, self.shard_count)
+				for shard_id in self.shard_ids]
+
+	@property
+	def identify_time(self):
+		return len(self.shard_ids) * IDENTIFY_INTERVAL
+
+	def start(self):
+		log.info('Starting shards {}'.format(self.shard_ids))
+		self.process = multiprocessing.Process(
+			target=run_shards,
+			args=(self.shard_ids, self.shard_count),
+			name='RickBot-shards-{}'.format(self.shard_ids[0])
+		)
+		self.process.start()
+		self.started_at = time.time()
+
+	def terminate(self):
+		# The shards close on SIGTERM
+		if self.process and self.process.is_alive():
+			self.process.terminate()
+
+	def stop(self, loop):
+		"""Terminates the process, the returned task kills it if it hangs"""
+		self.terminate()
+		process, self.process = self.process, None
+		self.stopping = loop.create_task(self.join(process, loop))
+		return self.stopping
+
+	async def join(self, process, loop):
+		if process is None:
+			return
+		# Joined in a thread so the other groups are still supervised
+		await loop.run_in_executor(None, process.join, STOP_TIMEOUT)
+		if process.is_alive():
+			process.kill()
+			await loop.run_in_executor(None, process.join)
+
+	@property
+	def stopped(self):
+		return self.process is None and \
+			(self.stopping is None or self.stopping.done())
+
+	def fail(self, loop):
+		"""Stops the process and schedules a restart with backoff"""
+		self.stop(loop)
+		delay = min(BACKOFF_BASE * 2 ** self.failures, BACKOFF_MAX)
+		self.failures += 1
+		self.restart_at = time.time() + delay
+		log.info('Shards {} down, restarting in {}s'.format(self.shard_ids,
+															delay))
+
+
+class Supervisor():
+
+	def __init__(self, shard_count, shards_per_process, loop):
+		self.loop = loop
+		self.shard_count = shard_count
+		self.groups = [
+			ShardGroup(list(range(i, min(i + shards_per_process, shard_count))),
+					   shard_count)
+			for i in range(0, shard_count, shards_per_process)
+		]
+		# Next time a process is allowed to start identifying
+		self.identify_at = 0
+
+	async def start_group(self, group):
+		delay = self.identify_at - time.time()
+		if delay > 0:
+			await asyncio.sleep(delay, loop=self.loop)
+		group.start()
+		self.identify_at = time.time() + group.identify_time
+
+	async def check_group(self, redis, group):
+		if group.process is None:
+			if group.stopped and time.time() >= group.restart_at:
+				await self.start_group(group)
+			return
+
+		if not group.process.is_alive():
+			group.fail(self.loop)
+			return
+
+		uptime = time.time() - group.started_at
+		if uptime < STARTUP_GRACE + group.identify_time:
+			return
+
+		beats = await redis.mget(*group.keys)
+		if not all(beats):
+			group.fail(self.loop)
+		elif uptime > HEALTHY_RESET:
+			group.failures = 0
+
+	async def run(self):
+		redis = await aioredis.create_redis(parse_redis_url(REDIS_URL),
+											encoding='utf-8', loop=self.loop)
+		log.info('Supervising {} shards in {} processes'.format(
+			self.shard_count,
+			len(self.groups)
+		))
+		try:
+			while True:
+				for group in self.groups:
+					await self.check_group(redis, group)
+				await asyncio.sleep(CHECK_INTERVAL, loop=self.loop)
+		finally:
+			# Every process gets SIGTERM first, then they close together
+			for group in self.groups:
+				group.terminate()
+			stopping = [group.stopping for group in self.groups
+						if group.stopping]
+			stopping += [group.stop(self.loop) for group in self.groups]
+			await asyncio.gather(*stopping, loop=self.loop)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	loop = asyncio.get_event_loop()
+
+	shard_count = SHARD_COUNT or \
+		loop.run_until_complete(recommended_shard_count(loop))
+	shards_per_process = SHARDS_PER_PROCESS or \
+		math.ceil(shard_count / multiprocessing.cpu_count())
+
+	supervisor = Supervisor(shard_count, shards_per_process, loop)
+	task = loop.create_task(supervisor.run())
+	# Stops the shard processes on the way out
+	loop.add_signal_handler(signal.SIGTERM, task.cancel)
+	try:
+		loop.run_until_complete(task)
+	except asyncio.CancelledError:
+		pass
@@ -1,5 +1,5 @@
 import aioredis
-import moto.motor_asyncio
+import motor.motor_asyncio
 import asyncio
 import logging
 from storage import Storage
@@ -14,6 +14,10 @@ class Db(object):
 		self.mongo_url = mongo_url
 		self.loop.create_task(self.create())
 		self.redis_address = parse_redis_url(redis_url)
+		self.mongo = motor.motor_asyncio.AsyncIOMotorClient(
+			mongo_url,
+			io_loop = loop
+		)
 
 	async def create(self):
 		self.redis = await aioredis.create_redis(
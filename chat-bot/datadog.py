@@ -1,9 +1,23 @@
 import aiomeasures
+import asyncio
 import logging
+import random
+import socket
+import re
 from functools import wraps
 
 log = logging.getLogger('discord')
 
+FLUSH_INTERVAL = 10
+# Keeps a packet under the usual 1500 bytes MTU
+MAX_PACKET_SIZE = 1432
+# Max number of distinct metrics between flushes
+MAX_METRICS = 10000
+MAX_SET_SIZE = 10000
+# Timing and histogram values kept per metric between flushes
+MAX_SAMPLES = 128
+
+
 def existance_check(f):
 	@wraps(f)
 	def wrapper(self, *args, **kwargs):
@@ -14,21 +28,66 @@ def existance_check(f):
 			log.debug('No Datadog agent found...')
 	return wrapper
 
+
+def parse_agent_url(dd_agent_url):
+	pattern = r'(?:udp:\/\/)?([a-zA-Z0-9.\-]*):?([0-9]*)?'
+	result = re.match(pattern, dd_agent_url).groups()
+	return (result[0] or 'localhost', int(result[1] or 8125))
+
+
 class DDAgent:
+	"""Datadog client aggregating metrics in memory
+
+	Counters, gauges and sets are aggregated by name and tags. Timings and
+	histograms keep a uniform sample of at most MAX_SAMPLES values per name
+	and tags, sent with the matching sample rate so the agent still counts
+	every value, and a busy metric can't crowd out the others. Everything
+	is flushed every FLUSH_INTERVAL seconds as multi-metric DogStatsD
+	packets. Events and service checks are sent right away through
+	aiomeasures.
 
-	def __init__(self, dd_agent_url=None):
+	"""
+
+	def __init__(self, dd_agent_url=None, loop=None):
 		self.dd_agent_url = dd_agent_url
 		self.agent = None
+		self.sock = None
+		self.connected = False
+		self.counters = {}
+		self.gauges = {}
+		self.sets = {}
+		# (name, tags, kind) -> [values seen, kept values, rate]
+		self.samples = {}
+		self.dropped = 0
 
 		if dd_agent_url:
 			self.agent = aiomeasures.Datadog(dd_agent_url)
+			self.address = parse_agent_url(dd_agent_url)
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.connect()
+			self.sock.setblocking(False)
+			if loop:
+				loop.create_task(self.flush_loop(loop))
 
-	@existance_check
-	def send(self, *args, **kwargs):
-		pass
+	def connect(self):
+		"""Resolves the agent's address once instead of on every sendto"""
+		try:
+			self.sock.connect(self.address)
+			self.connected = True
+		except OSError as e:
+			log.info('Could not resolve the Datadog agent: {}'.format(e))
+
+	def sampled(self, rate):
+		return rate >= 1 or random.random() < rate
+
+	def has_room(self, metrics, key):
+		if key in metrics or len(metrics) < MAX_METRICS:
+			return True
+		self.dropped += 1
+		return False
 
 	@existance_check
-	def set(self, *args, **kwargs):
+	def send(self, *args, **kwargs):
 		pass
 
 	@existance_check
@@ -36,9 +95,123 @@ class DDAgent:
 		pass
 
 	@existance_check
-	def incr(self, *args, **kwargs):
+	def check(self, *args, **kwargs):
 		pass
 
-	@existance_check
-	def check(self, *args, **kwargs):
-		pass
\ No newline at end of file
+	def incr(self, name, value=1, tags=None, rate=1):
+		if not self.sock or not self.sampled(rate):
+			return
+		key = (name, tags and tuple(tags))
+		if key in self.counters:
+			self.counters[key] += value / rate
+		elif self.has_room(self.counters, key):
+			self.counters[key] = value / rate
+
+	def decr(self, name, value=1, tags=None, rate=1):
+		self.incr(name, -value, tags, rate)
+
+	def gauge(self, name, value, tags=None, rate=1):
+		if not self.sock or not self.sampled(rate):
+			return
+		key = (name, tags and tuple(tags))
+		if self.has_room(self.gauges, key):
+			self.gauges[key] = value
+
+	def set(self, name, value, tags=None, rate=1):
+		if not self.sock or not self.sampled(rate):
+			return
+		key = (name, tags and tuple(tags))
+		values = self.sets.get(key)
+		if values is None:
+			if not self.has_room(self.sets, key):
+				return
+			values = self.sets[key] = set()
+		if len(values) < MAX_SET_SIZE:
+			values.add(value)
+
+	def sample(self, name, value, kind, tags=None, rate=1):
+		if not self.sock or not self.sampled(rate):
+			return
+		key = (name, tags and tuple(tags), kind)
+		reservoir = self.samples.get(key)
+		if reservoir is None:
+			if not self.has_room(self.samples, key):
+				return
+			reservoir = self.samples[key] = [0, [], rate]
+
+		reservoir[0] += 1
+		values = reservoir[1]
+		if len(values) < MAX_SAMPLES:
+			values.append(value)
+		else:
+			i = random.randrange(reservoir[0])
+			if i < MAX_SAMPLES:
+				values[i] = value
+
+	def timing(self, name, value, tags=None, rate=1):
+		self.sample(name, value, 'ms', tags, rate)
+
+	def histogram(self, name, value, tags=None, rate=1):
+		self.sample(name, value, 'h', tags, rate)
+
+	def format(self, name, tags, value, kind, rate=1):
+		line = '{}:{}|{}'.format(name, value, kind)
+		if rate < 1:
+			line += '|@{}'.format(rate)
+		if tags:
+			line += '|#' + ','.join(tags)
+		return line
+
+	def collect(self):
+		"""Drains the aggregated metrics into DogStatsD lines"""
+		counters, self.counters = self.counters, {}
+		gauges, self.gauges = self.gauges, {}
+		sets, self.sets = self.sets, {}
+		samples, self.samples = self.samples, {}
+
+		lines = []
+		for (name, tags), value in counters.items():
+			lines.append(self.format(name, tags, round(value), 'c'))
+		for (name, tags), value in gauges.items():
+			lines.append(self.format(name, tags, value, 'g'))
+		for (name, tags), values in sets.items():
+			lines.extend(self.format(name, tags, value, 's') for value in values)
+		for (name, tags, kind), (seen, values, rate) in samples.items():
+			rate = float('{:.3g}'.format(rate * len(values) / seen))
+			lines.extend(self.format(name, tags, value, kind, rate)
+						 for value in values)
+
+		if self.dropped:
+			lines.append(self.format('RickBot.dropped_metrics', None,
+									 self.dropped, 'c'))
+			self.dropped = 0
+
+		return lines
+
+	def flush(self):
+		if not self.connected:
+			self.connect()
+		packet = b''
+		for line in self.collect():
+			line = line.encode('utf-8')
+			if packet and len(packet) + len(line) + 1 > MAX_PACKET_SIZE:
+				self.send_packet(packet)
+				packet = b''
+			packet = packet + b'\n' + line if packet else line
+		if packet:
+			self.send_packet(packet)
+
+	def send_packet(self, packet):
+		try:
+			self.sock.send(packet)
+		except OSError as e:
+			log.debug('Could not send metrics: {}'.format(e))
+
+	async def flush_loop(self, loop):
+		while True:
+			await asyncio.sleep(FLUSH_INTERVAL, loop=loop)
+			try:
+				self.flush()
+			except Exception as e:
+				log.info('An error occured while flushing metrics')
+				log.info(e)
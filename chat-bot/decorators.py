@@ -2,6 +2,7 @@ import re
 import asyncio
 import logging
 from functools import wraps
+from scripts import Script
 
 log = logging.getLogger('discord')
 
@@ -10,7 +11,7 @@ def bg_task(sleep_time, ignore_errors=True):
 	def actual_decorator(func):
 		@wraps(func)
 		async def wrapper(self):
-			await RickBot.wait_until_ready()
+			await self.RickBot.wait_until_ready()
 			while True:
 				if ignore_errors:
 					try:
@@ -30,6 +31,94 @@ def bg_task(sleep_time, ignore_errors=True):
 
 	return actual_decorator
 
+# Evaluates every gate of a command and applies its cooldowns atomically
+#
+# KEYS: db_check, cooldown duration, global cooldown duration,
+#       global cooldown, user cooldown, require_role,
+#       require_one_of_roles, banned_role, banned_roles
+# ARGV: db_check flag, cooldown, global cooldown (-1 reads the duration
+#       from its key), require_role flag, require_one_of_roles flag,
+#       banned_role flag, banned_roles flag, author role ids...
+COMMAND_GATE = Script("""
+local roles = {}
+for i = 8, #ARGV do
+	roles[ARGV[i]] = true
+end
+
+if ARGV[1] == '1' then
+	local check = redis.call('GET', KEYS[1])
+	if not check or check == '' then
+		return 0
+	end
+end
+
+local function duration(key, value)
+	value = tonumber(value)
+	if value < 0 then
+		value = tonumber(redis.call('GET', key)) or 0
+	end
+	return value
+end
+
+local cooldown = duration(KEYS[2], ARGV[2])
+local global_cooldown = duration(KEYS[3], ARGV[3])
+
+if global_cooldown > 0 and redis.call('EXISTS', KEYS[4]) == 1 then
+	return 0
+end
+
+if cooldown > 0 and redis.call('EXISTS', KEYS[5]) == 1 then
+	return 0
+end
+
+if ARGV[4] == '1' and not roles[redis.call('GET', KEYS[6])] then
+	return 0
+end
+
+if ARGV[5] == '1' then
+	local authorized = false
+	for _, role in ipairs(redis.call('SMEMBERS', KEYS[7])) do
+		if roles[role] then
+			authorized = true
+			break
+		end
+	end
+	if not authorized then
+		return 0
+	end
+end
+
+if ARGV[6] == '1' and roles[redis.call('GET', KEYS[8])] then
+	return 0
+end
+
+if ARGV[7] == '1' then
+	for _, role in ipairs(redis.call('SMEMBERS', KEYS[9])) do
+		if roles[role] then
+			return 0
+		end
+	end
+end
+
+if global_cooldown > 0 then
+	redis.call('SET', KEYS[4], '1', 'EX', global_cooldown)
+end
+
+if cooldown > 0 then
+	redis.call('SET', KEYS[5], '1', 'EX', cooldown)
+end
+
+return 1
+""")
+
+
+def duration_arg(duration):
+	"""A cooldown given as a string is the storage key holding it"""
+	if isinstance(duration, str):
+		return -1
+	return duration or 0
+
+
 def command(pattern=None, db_check=False, user_check=None, db_name=None,
 			require_role="", require_one_of_roles="", banned_role="",
 			banned_roles="", cooldown=0, global_cooldown=0,
@@ -38,6 +127,10 @@ def command(pattern=None, db_check=False, user_check=None, db_name=None,
 		name = func.__name__
 		cmd_name = "!" + name
 		prog = re.compile(pattern or cmd_name)
+		cooldown_arg = duration_arg(cooldown)
+		global_cooldown_arg = duration_arg(global_cooldown)
+		gated = any([db_check, cooldown, global_cooldown, user_check,
+					 require_one_of_roles, banned_role, banned_roles])
 		@wraps(func)
 		async def wrapper(self, message):
 			match = prog.match(message.content)
@@ -47,87 +140,54 @@ def command(pattern=None, db_check=False, user_check=None, db_name=None,
 			args = match.groups()
 			server = message.server
 			author = message.author
-			author_role_ids = [role.id for role in author.roles]
-			storage = await self.get_storage(server)
 
 			is_owner = author.server.owner.id == author.id
 
 			perms = author.server_permissions
 			is_admin = perms.manage_server or perms.administrator or is_owner
 
-			if db_check:
-				check = await storage.get(db_name or name)
-				if not check:
+			if gated:
+				storage = await self.get_storage(server)
+				keys = [
+					db_name or name,
+					cooldown if isinstance(cooldown, str) else "",
+					global_cooldown if isinstance(global_cooldown, str) else "",
+					"cooldown:" + name,
+					"cooldown:" + name + ":" + author.id,
+					require_role,
+					require_one_of_roles,
+					banned_role,
+					banned_roles
+				]
+				gate_args = [
+					int(bool(db_check)),
+					cooldown_arg,
+					global_cooldown_arg,
+					int(bool(user_check) and not is_admin),
+					int(bool(require_one_of_roles) and not is_admin),
+					int(bool(banned_role)),
+					int(bool(banned_roles))
+				]
+				gate_args += [role.id for role in author.roles]
+				allowed = await storage.run_script(COMMAND_GATE, keys, gate_args)
+				if not allowed:
 					return
 
-			if isinstance(cooldown, str):
-				cooldown_dur = int(await storage.get(cooldown) or 0)
-			else:
-				cooldown_dur = cooldown
-
-			if isinstance(global_cooldown, str):
-				global_cooldown_dur = global_cooldown
-			else:
-				global_cooldown_dur = global_cooldown
-
-			if global_cooldown_dur != 0:
-				check = await storage.get("cooldown:" + name)
-				if check:
-					return
-
-			if user_check and not is_admin:
-				role_id = await storage.get(require_role)
-				if role_id not in author_role_ids:
-					return
-
-			if require_one_of_roles and is not is_admin:
-				role_ids = await storage.smembers(require_one_of_roles)
-				authorized = False
-				for role in author.roles:
-					if role.id in role_ids:
-						authorized = False
-						break
-
-					if not authorized:
-						return
-
-				if not authorized:
-					return
-
-			if banned_role:
-				role_id = await storage.get(banned_role)
-				if role.id in author_role_ids:
-					return
-
-			if banned_roles:
-				role_ids = await storage.smembers(banned_roles)
-				if any([role_id in author_role_ids
-						for role_id in role_ids]):
-
-						return
-
 			log.info("{}#{}@{} >> {}".format(message.author.name,
 											 message.author.discriminator,
 											 message.server.name,
 											 message.clean_content))
-			if global_cooldown_dur != 0:
-				await storage.set("cooldown:" + name, "1")
-				await storage.expire("cooldown:" + name, global_cooldown_dur)
-
-			if cooldown_dur != 0:
-				await storage.set("cooldown:" + name + ":" + author.id, "1")
-				await storage.expire("cooldown:" + name + ":" + author.id,
-									 global_cooldown_dur)
-
-				await func(self, message, args)
-			wrapper._db_check = db_check
-			wrapper._db_name = db_name
-			wrapper._is_command = True
-			if usage:
-				command_name = usage
-			else:
-				command_name = "!" + func.__name__
-			wrapper.info = {"name" : command_name,
-							"description" : description}
-			return wrapper
-		return actual_decorator
\ No newline at end of file
+			await func(self, message, args)
+
+		wrapper._db_check = db_check
+		wrapper._db_name = db_name
+		wrapper._is_command = True
+		wrapper._pattern = prog.pattern
+		if usage:
+			command_name = usage
+		else:
+			command_name = "!" + func.__name__
+		wrapper.info = {"name" : command_name,
+						"description" : description}
+		return wrapper
+	return actual_decorator
\ No newline at end of file
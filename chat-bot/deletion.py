@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+
+log = logging.getLogger('discord')
+
+PENDING_KEY = 'RickBot.pending_deletions'
+WHEEL_SIZE = 512
+TICK = 1
+BULK_SIZE = 100
+
+
+class DeletionScheduler():
+	"""Deletes bot messages after a delay with a single timer wheel
+
+	Messages are put in the slot of the second they are due, and every
+	tick the due messages are deleted, in bulk per channel. Pending
+	deletions are also kept in a Redis sorted set (scored by deadline) so
+	they survive a restart.
+
+	"""
+
+	def __init__(self, RickBot):
+		self.RickBot = RickBot
+		self.slots = [[] for _ in range(WHEEL_SIZE)]
+		# Last second the wheel went through
+		self.tick = int(time.time()) - 1
+		self.running = False
+
+	def schedule(self, message, delay):
+		"""Deletes the message in `delay` seconds"""
+		deadline = time.time() + delay
+		member = '{}:{}:{}'.format(message.channel.id, message.id,
+								   message.server.id)
+		self.add(deadline, member)
+		self.RickBot.loop.create_task(self.persist(deadline, member))
+
+	def add(self, deadline, member):
+		self.slots[int(deadline) % WHEEL_SIZE].append((deadline, member))
+
+	async def persist(self, deadline, member):
+		try:
+			await self.RickBot.db.redis.zadd(PENDING_KEY, deadline, member)
+		except Exception as e:
+			log.info('Could not persist the deletion of {}'.format(member))
+			log.info(e)
+
+	async def load(self):
+		"""Reschedules the deletions of this shard's servers"""
+		pending = await self.RickBot.db.redis.zrange(PENDING_KEY, 0, -1,
+													 withscores=True)
+		count = 0
+		now = time.time()
+		for member, deadline in pending:
+			server_id = member.rsplit(':', 1)[-1]
+			if self.RickBot.is_own_server(server_id):
+				# Overdue deletions happen on the next tick
+				self.add(max(float(deadline), now + TICK), member)
+				count += 1
+		log.info('Rescheduled {} pending deletions'.format(count))
+
+	def pop_due(self, now):
+		"""Removes and returns the entries due by now"""
+		due = []
+		while self.tick < int(now):
+			self.tick += 1
+			slot = self.slots[self.tick % WHEEL_SIZE]
+			if not slot:
+				continue
+			remaining = []
+			for entry in slot:
+				if entry[0] <= now:
+					due.append(entry[1])
+				else:
+					remaining.append(entry)
+			self.slots[self.tick % WHEEL_SIZE] = remaining
+		return due
+
+	async def delete(self, members):
+		http = self.RickBot.http
+		channels = {}
+		for member in members:
+			channel_id, message_id, server_id = member.split(':')
+			channels.setdefault((channel_id, server_id), []).append(message_id)
+
+		for (channel_id, server_id), message_ids in channels.items():
+			for i in range(0, len(message_ids), BULK_SIZE):
+				batch = message_ids[i:i + BULK_SIZE]
+				try:
+					if len(batch) == 1:
+						await http.delete_message(channel_id, batch[0],
+												  server_id)
+					else:
+						await http.delete_messages(channel_id, batch,
+												   server_id)
+				except Exception as e:
+					log.info('Could not delete messages in {}'.format(
+						channel_id
+					))
+					log.info(e)
+
+		await self.RickBot.db.redis.zrem(PENDING_KEY, *members)
+
+	async def run(self):
+		if self.running:
+			return
+		self.running = True
+
+		try:
+			await self.load()
+		except Exception as e:
+			log.info('Could not load the pending deletions')
+			log.info(e)
+
+		while True:
+			await asyncio.sleep(TICK)
+			due = self.pop_due(time.time())
+			if not due:
+				continue
+			try:
+				await self.delete(due)
+			except Exception as e:
+				log.info('An error occured while deleting messages')
+				log.info(e)
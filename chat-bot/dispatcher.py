@@ -0,0 +1,88 @@
+import asyncio
+import logging
+
+log = logging.getLogger('discord')
+
+
+class Dispatcher():
+	"""Dispatches plugin events through per-guild ordered queues
+
+	Every guild with pending events gets a bounded queue and a worker,
+	created on demand and retired as soon as the queue is empty, so the
+	events of a guild are handled in order and a slow handler only delays
+	its own guild. The handlers of an event run concurrently, with a global
+	cap on the number of handlers in flight. When a queue is full the
+	producer waits up to `put_timeout` seconds before the event is dropped.
+
+	"""
+
+	def __init__(self, loop, stats, queue_size=512, max_in_flight=256,
+				 put_timeout=0.5):
+		self.loop = loop
+		self.stats = stats
+		self.queue_size = queue_size
+		self.put_timeout = put_timeout
+		self.semaphore = asyncio.Semaphore(max_in_flight, loop=loop)
+		# guild id -> queue of its pending events
+		self.queues = {}
+		self.dropped = 0
+
+	def get_queue(self, guild_id):
+		queue = self.queues.get(guild_id)
+		if queue is None:
+			queue = self.queues[guild_id] = asyncio.Queue(self.queue_size,
+														  loop=self.loop)
+			self.loop.create_task(self.worker(guild_id, queue))
+		return queue
+
+	async def put(self, guild_id, event, plugins, *args):
+		"""Queues `event` to be called with `args` on every plugin"""
+		if not plugins:
+			return
+
+		queue = self.get_queue(guild_id)
+		item = (event, plugins, args)
+		try:
+			queue.put_nowait(item)
+			return
+		except asyncio.QueueFull:
+			pass
+
+		# Backpressure, then give up on the event
+		try:
+			await asyncio.wait_for(queue.put(item), self.put_timeout,
+								   loop=self.loop)
+		except asyncio.TimeoutError:
+			self.dropped += 1
+			self.stats.incr('RickBot.dropped_events')
+			log.info('Dropped {} for {}, queue is full'.format(event, guild_id))
+
+	async def worker(self, guild_id, queue):
+		# Nothing is awaited between the last get and the removal, so no
+		# event can be put in a retired queue
+		while not queue.empty():
+			event, plugins, args = queue.get_nowait()
+			try:
+				await asyncio.gather(
+					*[self.run(plugin, event, args) for plugin in plugins],
+					loop=self.loop
+				)
+			except Exception as e:
+				log.info('An error occured while dispatching {}'.format(event))
+				log.info(e)
+		del self.queues[guild_id]
+
+	async def run(self, plugin, event, args):
+		plugin_name = plugin.__class__.__name__
+		async with self.semaphore:
+			start = self.loop.time()
+			try:
+				await getattr(plugin, event)(*args)
+			except Exception as e:
+				log.info('An error occured in {}.{}'.format(plugin_name, event))
+				log.info(e)
+			finally:
+				duration = (self.loop.time() - start) * 1000
+				self.stats.histogram('RickBot.handler_latency', duration,
+									 tags=['plugin:' + plugin_name,
+										   'event:' + event.lstrip('_')])
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger('discord')
+
+EXTRACTOR_PROCESSES = int(os.getenv('EXTRACTOR_PROCESSES') or 2)
+# Seconds an extraction gets once it runs in an extractor process
+EXTRACT_TIMEOUT = int(os.getenv('EXTRACT_TIMEOUT') or 30)
+# Extra seconds before a process that ignored its alarm is given up on
+STUCK_GRACE = 10
+CACHE_SIZE = 1024
+CACHE_TTL = 3600 * 24 * 7
+# Only these fields are kept, the stream urls expire long before the cache
+INFO_FIELDS = ('id', 'title', 'duration', 'thumbnail', 'webpage_url',
+			   'uploader')
+# Lifetime assumed for stream urls that don't say when they expire
+STREAM_TTL = 3600
+YTDL_OPTIONS = {
+	'format' : 'webm[abr>0]/bestaudio/best',
+	'prefer_ffmpeg' : True,
+	'default_search' : 'auto',
+	'socket_timeout' : 10,
+	'quiet' : True
+}
+
+
+def run_ytdl(url):
+	import youtube_dl
+
+	ydl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+	info = ydl.extract_info(url, download=False)
+	if "entries" in info:
+		info = info['entries'][0]
+	return info
+
+
+def stream_expiry(stream_url):
+	"""Unix time a stream url stops working, from its `expire` parameter"""
+	from urllib.parse import urlparse, parse_qs
+
+	parsed = urlparse(stream_url)
+	expire = parse_qs(parsed.query).get('expire')
+	if not expire:
+		# googlevideo urls can carry their parameters in the path
+		parts = parsed.path.split('/')
+		if 'expire' in parts[:-1]:
+			expire = [parts[parts.index('expire') + 1]]
+	try:
+		return int(expire[0])
+	except (TypeError, ValueError):
+		return int(time.time()) + STREAM_TTL
+
+
+def extract_info(url):
+	"""Runs youtube_dl in an extractor process"""
+	info = run_ytdl(url)
+	return {field : info.get(field) for field in INFO_FIELDS}
+
+
+def run_with_alarm(func, url, timeout):
+	"""Runs an extraction in an extractor process for at most `timeout`
+	seconds, the process stays usable once it's interrupted"""
+	def expired(signum, frame):
+		raise TimeoutError('Extraction took more than {}s'.format(timeout))
+
+	previous = signal.signal(signal.SIGALRM, expired)
+	signal.alarm(timeout)
+	try:
+		return func(url)
+	finally:
+		signal.alarm(0)
+		signal.signal(signal.SIGALRM, previous)
+
+
+def resolve_stream(url):
+	"""Resolves the direct audio stream of a page in an extractor process"""
+	info = run_ytdl(url)
+	return {
+		'url' : url,
+		'stream_url' : info['url'],
+		'expires_at' : stream_expiry(info['url']),
+		'title' : info.get('title'),
+		'duration' : info.get('duration'),
+		'acodec' : info.get('acodec')
+	}
+
+
+class AudioInfoCache():
+	"""Audio metadata by URL
+
+	Looks in an in-process LRU, then in Redis, and only then runs youtube_dl
+	in a dedicated process pool so extractions can't starve the default
+	executor. Concurrent requests for the same URL share one extraction.
+	An extraction is only submitted once a process is free for it, and
+	fails after running for `timeout` seconds.
+
+	"""
+
+	def __init__(self, db, loop, processes=EXTRACTOR_PROCESSES,
+				 timeout=EXTRACT_TIMEOUT):
+		self.db = db
+		self.loop = loop
+		self.processes = processes
+		self.timeout = timeout
+		self.pool = ProcessPoolExecutor(max_workers=processes)
+		self.slots = asyncio.Semaphore(processes, loop=loop)
+		self.cache = OrderedDict()
+		self.pending = {}
+
+	def key(self, url):
+		return 'Music.audio_info:{}'.format(
+			hashlib.sha1(url.encode('utf-8')).hexdigest()
+		)
+
+	def remember(self, url, info):
+		self.cache[url] = info
+		self.cache.move_to_end(url)
+		if len(self.cache) > CACHE_SIZE:
+			self.cache.popitem(last=False)
+
+	async def get(self, url):
+		info = self.cache.get(url)
+		if info is not None:
+			self.cache.move_to_end(url)
+			return info
+
+		pending = self.pending.get(url)
+		if pending is None:
+			pending = asyncio.ensure_future(self.fetch(url), loop=self.loop)
+			self.pending[url] = pending
+			pending.add_done_callback(lambda f: self.pending.pop(url, None))
+
+		return await asyncio.shield(pending, loop=self.loop)
+
+	async def fetch(self, url):
+		key = self.key(url)
+		cached = await self.db.redis.get(key)
+		if cached:
+			info = json.loads(cached)
+		else:
+			info = await self.run(extract_info, url)
+			await self.db.redis.setex(key, CACHE_TTL, json.dumps(info))
+
+		self.remember(url, info)
+		return info
+
+	async def resolve(self, url):
+		"""Direct stream of a url, never cached as it expires"""
+		return await self.run(resolve_stream, url)
+
+	async def run(self, func, url):
+		# Waiting for a free process doesn't count toward the timeout
+		async with self.slots:
+			pool = self.pool
+			future = self.loop.run_in_executor(pool, run_with_alarm, func, url,
+											   self.timeout)
+			try:
+				return await asyncio.wait_for(future,
+											  self.timeout + STUCK_GRACE,
+											  loop=self.loop)
+			except asyncio.TimeoutError:
+				log.info('Extraction of {} is stuck'.format(url))
+				# The stuck process is left to the old pool, whose other
+				# extractions still finish
+				if self.pool is pool:
+					self.pool = ProcessPoolExecutor(max_workers=self.processes)
+					pool.shutdown(wait=False)
+				raise
+
+	def close(self):
+		self.pool.shutdown(wait=False)
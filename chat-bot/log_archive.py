@@ -0,0 +1,233 @@
+"""Compressed archive of old message logs
+
+Every server gets two append-only files in the archive directory:
+
+- `{server_id}.logs` holds zlib compressed blocks, each block being the
+  line-delimited JSON messages of one channel on one day
+- `{server_id}.index` holds one JSON line per block with its day,
+  channel, offset, length, message count and first/last timestamps
+
+A block is written (and synced) before its index line, so a crash can
+leave unindexed bytes in the data file but never a broken index entry.
+A crash between archiving and deleting from Mongo archives the same
+messages again on the next run, the reader skips those duplicates.
+
+"""
+import os
+import mmap
+import json
+import zlib
+import heapq
+import logging
+import calendar
+from datetime import datetime
+
+log = logging.getLogger('discord')
+
+BLOCK_SIZE = 1000
+
+
+def day_of(timestamp):
+	return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def message_key(message):
+	return (message['timestamp'], message.get('_id', ''))
+
+
+class ArchiveWriter():
+
+	def __init__(self, archive_dir, server_id):
+		self.data_path = os.path.join(archive_dir, '{}.logs'.format(server_id))
+		self.index_path = os.path.join(archive_dir, '{}.index'.format(server_id))
+
+	def append(self, day, channel, messages):
+		"""Appends the messages of a channel's day, BLOCK_SIZE per block"""
+		with open(self.data_path, 'ab') as data, \
+				open(self.index_path, 'a') as index:
+			for i in range(0, len(messages), BLOCK_SIZE):
+				block = messages[i:i + BLOCK_SIZE]
+				lines = '\n'.join(json.dumps(message, default=str)
+								  for message in block)
+				compressed = zlib.compress(lines.encode('utf-8'), 6)
+
+				offset = data.seek(0, os.SEEK_END)
+				data.write(compressed)
+				data.flush()
+				os.fsync(data.fileno())
+
+				index.write(json.dumps({
+					'day' : day,
+					'channel' : channel,
+					'offset' : offset,
+					'length' : len(compressed),
+					'count' : len(block),
+					'first' : block[0]['timestamp'],
+					'last' : block[-1]['timestamp']
+				}))
+				index.write('\n')
+				index.flush()
+
+
+class LogArchiver():
+	"""Moves the logs older than a cutoff from Mongo to the archive"""
+
+	def __init__(self, mongo_db, archive_dir, loop):
+		self.mongo_db = mongo_db
+		self.archive_dir = archive_dir
+		self.loop = loop
+		os.makedirs(archive_dir, exist_ok=True)
+
+	async def run(self, cutoff):
+		for name in sorted(await self.mongo_db.collection_names()):
+			if not name.startswith('messages:'):
+				continue
+			year, month = map(int, name[len('messages:'):].split('-'))
+			if calendar.timegm((year, month, 1, 0, 0, 0)) >= cutoff:
+				continue
+
+			count = await self.archive_collection(name, cutoff)
+			log.info('Archived {} messages from {}'.format(count, name))
+
+	async def write(self, collection, server_id, day, channel, messages):
+		"""Archives messages, then deletes exactly those from Mongo"""
+		writer = ArchiveWriter(self.archive_dir, server_id)
+		await self.loop.run_in_executor(None, writer.append, day, channel,
+										messages)
+		ids = [message['_id'] for message in messages]
+		await collection.delete_many({'_id' : {'$in' : ids}})
+
+	async def archive_collection(self, name, cutoff):
+		collection = self.mongo_db[name]
+		query = {'timestamp' : {'$lt' : cutoff}}
+		cursor = collection.find(query).sort([('server', 1),
+											  ('timestamp', 1),
+											  ('_id', 1)])
+		count = 0
+		server_id = None
+		# (day, channel) -> messages of the current server
+		buckets = {}
+		while await cursor.fetch_next:
+			message = cursor.next_object()
+			if message['server'] != server_id:
+				for (day, channel), messages in buckets.items():
+					if messages:
+						await self.write(collection, server_id, day, channel,
+										 messages)
+				buckets = {}
+				server_id = message['server']
+
+			key = (day_of(message['timestamp']), message['channel'])
+			bucket = buckets.setdefault(key, [])
+			bucket.append(message)
+			count += 1
+			if len(bucket) >= BLOCK_SIZE:
+				await self.write(collection, server_id, key[0], key[1], bucket)
+				buckets[key] = []
+
+		for (day, channel), messages in buckets.items():
+			if messages:
+				await self.write(collection, server_id, day, channel,
+								 messages)
+
+		# Logs inserted during the scan (like spill replays) weren't
+		# archived and are still there, the next run gets them
+		year, month = map(int, name[len('messages:'):].split('-'))
+		year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+		if calendar.timegm((year, month, 1, 0, 0, 0)) <= cutoff and \
+				not await collection.count():
+			await self.mongo_db.drop_collection(name)
+
+		return count
+
+
+class ArchiveReader():
+	"""Reads the archive of a server through a memory map"""
+
+	def __init__(self, archive_dir, server_id):
+		self.data_path = os.path.join(archive_dir, '{}.logs'.format(server_id))
+		self.index_path = os.path.join(archive_dir, '{}.index'.format(server_id))
+		self.blocks = []
+		self.data = None
+
+		if not os.path.exists(self.index_path):
+			return
+
+		with open(self.index_path) as index:
+			for line in index:
+				try:
+					self.blocks.append(json.loads(line))
+				except ValueError:
+					# Torn line of an interrupted write
+					continue
+		self.blocks.sort(key=lambda block: block['first'])
+
+		if self.blocks:
+			with open(self.data_path, 'rb') as data:
+				self.data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def close(self):
+		if self.data:
+			self.data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def days(self):
+		return sorted(set(block['day'] for block in self.blocks))
+
+	def channels(self, day):
+		return sorted(set(block['channel'] for block in self.blocks
+						  if block['day'] == day))
+
+	def read_block(self, block):
+		offset = block['offset']
+		compressed = self.data[offset:offset + block['length']]
+		for line in zlib.decompress(compressed).decode('utf-8').split('\n'):
+			yield json.loads(line)
+
+	def read_day(self, day, channel=None):
+		blocks = [block for block in self.blocks if block['day'] == day and
+				  (not channel or block['channel'] == channel)]
+		yield from self.merge(blocks, float('-inf'), float('inf'))
+
+	def read_range(self, start, end, channel=None):
+		"""Yields the messages of a time range sorted by timestamp and _id"""
+		blocks = [block for block in self.blocks
+				  if block['last'] >= start and block['first'] <= end and
+				  (not channel or block['channel'] == channel)]
+		yield from self.merge(blocks, start, end)
+
+	def merge(self, blocks, start, end):
+		"""Merges blocks sorted by first timestamp into one sorted stream"""
+		# Blocks of a channel usually follow each other in time and are
+		# read one after the other. A block archived late for an old day
+		# (or again after a crash) overlaps them and starts another run,
+		# the runs are merged lazily.
+		runs = []
+		for block in blocks:
+			for run in runs:
+				if run[-1]['last'] < block['first']:
+					run.append(block)
+					break
+			else:
+				runs.append([block])
+
+		streams = [self.read_blocks(run, start, end) for run in runs]
+		previous = None
+		for message in heapq.merge(*streams, key=message_key):
+			# Copies of a message are merged next to each other
+			key = message_key(message)
+			if '_id' in message and key == previous:
+				continue
+			previous = key
+			yield message
+
+	def read_blocks(self, blocks, start, end):
+		for block in blocks:
+			for message in self.read_block(block):
+				if start <= message['timestamp'] <= end:
+					yield message
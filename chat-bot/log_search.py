@@ -0,0 +1,578 @@
+"""Inverted index over the message logs
+
+The Logs plugin appends every message's terms to an append-only journal
+per server (`{server_id}.journal`, one JSON line per message). A
+`GuildIndex` loads a journal into in-memory postings and then only reads
+the lines appended since its last refresh.
+
+Every posting points to the day, channel and timestamp of the message,
+which is what the logs viewer pages by.
+
+	python log_search.py serve
+
+runs the search process the website queries over HTTP. It is the only
+one holding indexes, the least recently searched ones are dropped once
+they go over `LOGS_SEARCH_BUDGET` indexed messages. Indexes are loaded
+by a background thread, the most recently written ones at startup, and
+a search on an index that isn't loaded yet answers `loading`.
+
+Once `COMPACT_AFTER` entries were read from a journal, the search
+process saves the postings to `{server_id}.postings` and empties the
+journal, so an index loads from its postings plus a short journal.
+Appends and compactions take an flock on the journal.
+
+	python log_search.py rebuild <server_id>
+
+rebuilds the journal of a server from the archive and Mongo.
+
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import fcntl
+import heapq
+import queue
+import pickle
+import asyncio
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('discord')
+
+TERM_RE = re.compile(r'\w{2,32}')
+MAX_TERMS = 64
+# Indexed messages kept in memory by the search process
+LOGS_SEARCH_BUDGET = int(os.getenv('LOGS_SEARCH_BUDGET') or 5000000)
+LOGS_SEARCH_ADDRESS = os.getenv('LOGS_SEARCH_ADDRESS', '127.0.0.1:5100')
+# Journal entries read since the postings were saved before compacting
+COMPACT_AFTER = 100000
+# Messages this much older than the start of a rebuild can't be in the
+# entries the bot appends during it
+REBUILD_MARGIN = 300
+
+
+def tokenize(content):
+	return Counter(TERM_RE.findall(content.casefold())[:MAX_TERMS])
+
+
+def journal_entry(message, day):
+	author = message['author']
+	return {
+		't' : message['timestamp'],
+		'd' : day,
+		'c' : message['channel'],
+		'i' : message.get('id'),
+		'a' : [author['id'], author['name'].casefold()],
+		'w' : tokenize(message.get('content') or '')
+	}
+
+
+def parse_query(query):
+	"""Splits a query into its terms and its author:X filters"""
+	terms = []
+	authors = []
+	for word in query.split():
+		if word.lower().startswith('author:'):
+			author = word[len('author:'):].casefold()
+			if author:
+				authors.append(author.split('#')[0])
+		else:
+			terms.extend(tokenize(word))
+	return terms, authors
+
+
+class JournalWriter():
+	"""Buffers journal entries and appends them every `flush_interval`"""
+
+	def __init__(self, index_dir, loop, flush_interval=2):
+		self.index_dir = index_dir
+		self.loop = loop
+		self.flush_interval = flush_interval
+		self.buffers = {}
+		os.makedirs(index_dir, exist_ok=True)
+		self.task = loop.create_task(self.flush_loop())
+
+	def add(self, server_id, message, day):
+		entry = json.dumps(journal_entry(message, day))
+		self.buffers.setdefault(server_id, []).append(entry)
+
+	def flush(self):
+		buffers, self.buffers = self.buffers, {}
+		for server_id, entries in buffers.items():
+			path = os.path.join(self.index_dir, '{}.journal'.format(server_id))
+			if not self.append(path, entries):
+				# Being compacted or rebuilt, kept for the next flush
+				self.buffers[server_id] = entries + \
+					self.buffers.get(server_id, [])
+
+	def append(self, path, entries):
+		with open(path, 'a') as journal:
+			try:
+				fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return False
+			# Replaced since it was opened
+			if os.fstat(journal.fileno()).st_ino != os.stat(path).st_ino:
+				return False
+			journal.write('\n'.join(entries))
+			journal.write('\n')
+		return True
+
+	async def flush_loop(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			try:
+				self.flush()
+			except Exception as e:
+				log.info('An error occured while writing the search journal')
+				log.info(e)
+
+	async def close(self):
+		self.task.cancel()
+		self.flush()
+
+
+class GuildIndex():
+
+	SAVED_FIELDS = ('inode', 'offset', 'timestamps', 'days', 'channels',
+					'ids', 'authors', 'postings', 'author_postings')
+
+	def __init__(self, index_dir, server_id):
+		self.path = os.path.join(index_dir, '{}.journal'.format(server_id))
+		self.postings_path = os.path.join(index_dir,
+										  '{}.postings'.format(server_id))
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.offset = 0
+		self.inode = None
+		# Entries read since the postings were saved
+		self.unsaved = 0
+		self.timestamps = array('d')
+		self.days = []
+		self.channels = []
+		self.ids = []
+		self.authors = []
+		# term -> (doc numbers, term frequencies)
+		self.postings = {}
+		# author id or name -> doc numbers
+		self.author_postings = {}
+
+	def __len__(self):
+		return len(self.timestamps)
+
+	def add(self, entry):
+		doc = len(self.timestamps)
+		self.timestamps.append(entry['t'])
+		self.days.append(entry['d'])
+		self.channels.append(entry['c'])
+		self.ids.append(entry['i'])
+		self.authors.append(entry['a'][0])
+
+		for author in entry['a']:
+			docs = self.author_postings.get(author)
+			if docs is None:
+				docs = self.author_postings[author] = array('I')
+			docs.append(doc)
+
+		for term, tf in entry['w'].items():
+			posting = self.postings.get(term)
+			if posting is None:
+				posting = self.postings[term] = (array('I'), array('H'))
+			posting[0].append(doc)
+			posting[1].append(min(tf, 0xffff))
+
+	def load(self):
+		"""Starts from the saved postings if they go with the journal"""
+		try:
+			with open(self.postings_path, 'rb') as saved:
+				state = pickle.load(saved)
+			inode = os.stat(self.path).st_ino
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return False
+		if state.get('inode') != inode:
+			return False
+		for field in self.SAVED_FIELDS:
+			setattr(self, field, state[field])
+		self.unsaved = 0
+		return True
+
+	def save(self):
+		tmp_path = self.postings_path + '.tmp'
+		with open(tmp_path, 'wb') as saved:
+			pickle.dump({field : getattr(self, field)
+						 for field in self.SAVED_FIELDS},
+						saved, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, self.postings_path)
+		self.unsaved = 0
+
+	def compact(self):
+		"""Saves the postings and empties the journal they cover
+
+		The saved postings point to the new journal before it replaces
+		the old one, so a crash in between only discards them.
+
+		"""
+		with open(self.path, 'a') as journal:
+			fcntl.flock(journal, fcntl.LOCK_EX)
+			if os.fstat(journal.fileno()).st_ino != os.stat(self.path).st_ino:
+				return
+			# Nothing can be appended until the new journal is in place
+			self.refresh()
+			tmp_path = self.path + '.compact'
+			open(tmp_path, 'w').close()
+			self.inode = os.stat(tmp_path).st_ino
+			self.offset = 0
+			self.save()
+			os.replace(tmp_path, self.path)
+
+	def refresh(self):
+		"""Reads the journal lines appended since the last refresh
+
+		Returns False when the journal was replaced by a rebuild, the index
+		has to be loaded again.
+
+		"""
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return not self.offset
+
+		if self.inode is None:
+			self.inode = stat.st_ino
+		elif stat.st_ino != self.inode or stat.st_size < self.offset:
+			return False
+
+		if stat.st_size == self.offset:
+			return True
+
+		with open(self.path, 'rb') as journal:
+			journal.seek(self.offset)
+			for line in journal:
+				# Partially written line, read it on the next refresh
+				if not line.endswith(b'\n'):
+					break
+				self.offset += len(line)
+				try:
+					self.add(json.loads(line.decode('utf-8')))
+				except ValueError:
+					continue
+				self.unsaved += 1
+		return True
+
+	def search(self, query, page=0, per_page=20):
+		"""Returns a page of the messages matching every term of the query
+
+		Messages are ranked by tf-idf, then by recency. `author:X` only
+		keeps the messages of the author with the id or name X.
+
+		"""
+		terms, authors = parse_query(query)
+		terms = list(set(terms))
+		if not terms and not authors:
+			return {'total' : 0, 'results' : []}
+
+		n = len(self)
+		postings = []
+		for term in terms:
+			posting = self.postings.get(term)
+			if posting is None:
+				return {'total' : 0, 'results' : []}
+			idf = math.log(1 + n / len(posting[0]))
+			postings.append((posting[0], posting[1], idf))
+		postings.sort(key=lambda posting: len(posting[0]))
+
+		author_docs = None
+		if authors:
+			author_docs = sorted(set(doc for author in authors
+									 for doc in self.author_postings.get(author, ())))
+
+		# Start from the shortest list, then only look up its documents
+		if author_docs is not None and \
+				(not postings or len(author_docs) < len(postings[0][0])):
+			scores = dict.fromkeys(author_docs, 0.0)
+			author_docs = None
+		else:
+			docs, tfs, idf = postings.pop(0)
+			scores = {doc : (1 + math.log(tf)) * idf
+					  for doc, tf in zip(docs, tfs)}
+
+		for docs, tfs, idf in postings:
+			for doc in list(scores):
+				i = bisect_left(docs, doc)
+				if i < len(docs) and docs[i] == doc:
+					scores[doc] += (1 + math.log(tfs[i])) * idf
+				else:
+					del scores[doc]
+
+		if author_docs is not None:
+			for doc in list(scores):
+				i = bisect_left(author_docs, doc)
+				if i == len(author_docs) or author_docs[i] != doc:
+					del scores[doc]
+
+		top = heapq.nlargest((page + 1) * per_page, scores.items(),
+							 key=lambda item: (item[1], item[0]))
+		results = [{
+			'day' : self.days[doc],
+			'channel' : self.channels[doc],
+			'timestamp' : self.timestamps[doc],
+			'id' : self.ids[doc],
+			'author' : self.authors[doc],
+			'score' : score
+		} for doc, score in top[page * per_page:]]
+
+		return {'total' : len(scores), 'results' : results}
+
+
+class IndexCache():
+	"""Least recently searched indexes, up to `budget` indexed messages
+
+	Indexes are loaded one at a time by a background thread, searches
+	only read the journal lines appended since the last one. The index
+	loaded last is always kept, even over the budget.
+
+	"""
+
+	def __init__(self, index_dir, budget=LOGS_SEARCH_BUDGET):
+		self.index_dir = index_dir
+		self.budget = budget
+		self.indexes = OrderedDict()
+		self.lock = threading.Lock()
+		self.loading = set()
+		self.queue = queue.Queue()
+		self.loader = threading.Thread(target=self.load_loop, daemon=True)
+		self.loader.start()
+
+	@property
+	def size(self):
+		return sum(len(index) for index in self.indexes.values())
+
+	def schedule(self, server_id, prewarm=False):
+		"""Queues the loading of an index, called with the lock held"""
+		if server_id not in self.loading:
+			self.loading.add(server_id)
+			self.queue.put((server_id, prewarm))
+
+	def prewarm(self):
+		"""Queues the most recently written journals"""
+		journals = [entry for entry in os.scandir(self.index_dir)
+					if entry.name.endswith('.journal')]
+		journals.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+		with self.lock:
+			for entry in journals:
+				try:
+					self.schedule(int(entry.name[:-len('.journal')]), True)
+				except ValueError:
+					continue
+
+	def load(self, server_id):
+		index = GuildIndex(self.index_dir, server_id)
+		start = time.time()
+		index.load()
+		if not index.refresh():
+			# Rebuilt while loading
+			index.reset()
+			index.refresh()
+		if index.unsaved >= COMPACT_AFTER:
+			index.compact()
+		log.info('Loaded the index of {}, {} messages in {:.1f}s'.format(
+			server_id, len(index), time.time() - start))
+		return index
+
+	def load_loop(self):
+		while True:
+			server_id, prewarm = self.queue.get()
+			index = None
+			with self.lock:
+				full = self.size >= self.budget
+			# Prewarming stops once the budget is used
+			if not prewarm or not full:
+				try:
+					index = self.load(server_id)
+				except Exception as e:
+					log.info('Could not load the index of {}'.format(server_id))
+					log.info(e)
+
+			with self.lock:
+				self.loading.discard(server_id)
+				if index is not None:
+					self.indexes.pop(server_id, None)
+					self.indexes[server_id] = index
+					self.evict()
+
+	def evict(self):
+		size = self.size
+		while size > self.budget and len(self.indexes) > 1:
+			server_id, index = self.indexes.popitem(last=False)
+			size -= len(index)
+
+	def search(self, server_id, query, page=0, per_page=20):
+		"""A page of results, None while the index is being loaded"""
+		with self.lock:
+			index = self.indexes.get(server_id)
+			if index is None:
+				self.schedule(server_id)
+				return None
+			self.indexes.move_to_end(server_id)
+
+		with index.lock:
+			if not index.refresh():
+				# Serves the old index until the new one is loaded
+				with self.lock:
+					self.schedule(server_id)
+			if index.unsaved >= COMPACT_AFTER:
+				with self.lock:
+					self.schedule(server_id)
+			return index.search(query, page=page, per_page=per_page)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+	"""GET /<server_id>?q=...&page=0&per_page=20"""
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		args = parse_qs(url.query)
+		try:
+			server_id = int(url.path.strip('/'))
+			page = max(int(args.get('page', ['0'])[0]), 0)
+			per_page = max(1, min(int(args.get('per_page', ['20'])[0]), 100))
+		except ValueError:
+			self.reply(400, {'error' : 'bad_request'})
+			return
+
+		try:
+			result = self.server.cache.search(server_id,
+											  args.get('q', [''])[0],
+											  page=page, per_page=per_page)
+		except Exception as e:
+			log.info('An error occured while searching {}'.format(server_id))
+			log.info(e)
+			self.reply(500, {'error' : 'search_failed'})
+			return
+
+		if result is None:
+			self.reply(202, {'loading' : True})
+		else:
+			self.reply(200, result)
+
+	def reply(self, code, body):
+		body = json.dumps(body).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		log.debug(format % args)
+
+
+class SearchServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+def serve(index_dir, address=LOGS_SEARCH_ADDRESS, budget=LOGS_SEARCH_BUDGET):
+	"""Serves the searches of the website from a single process"""
+	host, _, port = address.rpartition(':')
+	server = SearchServer((host or '127.0.0.1', int(port)), SearchHandler)
+	os.makedirs(index_dir, exist_ok=True)
+	server.cache = IndexCache(index_dir, budget)
+	server.cache.prewarm()
+	log.info('Serving searches on {}'.format(address))
+	server.serve_forever()
+
+
+def rebuild(server_id, index_dir, archive_dir, mongo_db):
+	"""Rewrites the journal of a server from the archive and Mongo
+
+	The entries the bot appends to the old journal in the meantime are
+	carried over, except the messages already read from Mongo.
+
+	"""
+	from log_archive import ArchiveReader, day_of
+
+	path = os.path.join(index_dir, '{}.journal'.format(server_id))
+	tmp_path = path + '.rebuild'
+	count = 0
+	os.makedirs(index_dir, exist_ok=True)
+	try:
+		stat = os.stat(path)
+		inode, offset = stat.st_ino, stat.st_size
+	except FileNotFoundError:
+		inode, offset = None, 0
+	since = time.time() - REBUILD_MARGIN
+	recent_ids = set()
+
+	with open(tmp_path, 'w') as journal:
+		def write(message):
+			journal.write(json.dumps(journal_entry(message,
+												   day_of(message['timestamp']))))
+			journal.write('\n')
+			if message['timestamp'] >= since and message.get('id'):
+				recent_ids.add(message['id'])
+
+		with ArchiveReader(archive_dir, server_id) as archive:
+			for message in archive.read_range(0, float('inf')):
+				write(message)
+				count += 1
+
+		names = sorted(name for name in mongo_db.collection_names()
+					   if name.startswith('messages:'))
+		for name in names:
+			cursor = mongo_db[name].find({'server' : str(server_id)})\
+				.sort([('timestamp', 1), ('_id', 1)])
+			for message in cursor:
+				write(message)
+				count += 1
+
+	with open(path, 'a') as old:
+		fcntl.flock(old, fcntl.LOCK_EX)
+		# Compacted during the rebuild, everything in it is new
+		if os.fstat(old.fileno()).st_ino != inode:
+			offset = 0
+		with open(path, 'rb') as tail, open(tmp_path, 'ab') as journal:
+			tail.seek(offset)
+			for line in tail:
+				if not line.endswith(b'\n'):
+					break
+				try:
+					entry = json.loads(line.decode('utf-8'))
+				except ValueError:
+					continue
+				if entry.get('i') not in recent_ids:
+					journal.write(line)
+					count += 1
+		os.replace(tmp_path, path)
+
+	return count
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	if sys.argv[1:] == ['serve']:
+		serve(os.getenv('LOGS_INDEX_DIR', 'logs_index'))
+		sys.exit(0)
+
+	if len(sys.argv) != 3 or sys.argv[1] != 'rebuild':
+		print('usage: python log_search.py serve | rebuild <server_id>')
+		sys.exit(1)
+
+	import pymongo
+
+	mongo = pymongo.MongoClient(os.getenv('MONGO_URL'))
+	count = rebuild(sys.argv[2],
+					os.getenv('LOGS_INDEX_DIR', 'logs_index'),
+					os.getenv('LOGS_ARCHIVE_DIR', 'logs_archive'),
+					mongo.logs)
+	log.info('Indexed {} messages'.format(count))
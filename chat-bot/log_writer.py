@@ -0,0 +1,204 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+log = logging.getLogger('discord')
+
+# Log queries read a server (and usually one of its channels) over a time
+# range, sorted by timestamp then _id
+LOG_INDEXES = [
+	[('server', 1), ('channel', 1), ('timestamp', 1), ('_id', 1)],
+	[('server', 1), ('timestamp', 1), ('_id', 1)],
+]
+DUPLICATE_KEY = 11000
+
+
+def month_collection(timestamp):
+	"""Name of the monthly collection holding the logs of a timestamp"""
+	date = datetime.utcfromtimestamp(timestamp)
+	return 'messages:{:04}-{:02}'.format(date.year, date.month)
+
+
+class LogWriter():
+	"""Write-behind buffer for the message logs
+
+	Documents are grouped by collection and written with insert_many once
+	a collection holds `batch_size` documents or every `flush_interval`
+	seconds. At most `max_buffered` documents are kept in memory, past
+	that (or when Mongo is unavailable) they are spilled to a local
+	line-delimited JSON file which is replayed once Mongo is back.
+
+	A failed insert_many may have written part of its batch, so spilled
+	documents keep their _id and duplicates are ignored on replay. The
+	spill file is only touched from a single thread, off the loop.
+
+	"""
+
+	def __init__(self, mongo_db, loop, batch_size=500, flush_interval=2,
+				 max_buffered=50000, spill_path='logs.spill'):
+		self.mongo_db = mongo_db
+		self.loop = loop
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_buffered = max_buffered
+		self.spill_path = spill_path
+		self.buffers = {}
+		self.buffered = 0
+		self.flushing = set()
+		self.indexed = set()
+		# Flushes started by a full batch and spills not written yet
+		self.pending = set()
+		self.spill_pool = ThreadPoolExecutor(max_workers=1)
+		self.task = loop.create_task(self.flush_loop())
+
+	def add(self, collection, doc):
+		if self.buffered >= self.max_buffered:
+			self.track(self.spill(collection, [doc]))
+			return
+
+		buffer = self.buffers.setdefault(collection, [])
+		buffer.append(doc)
+		self.buffered += 1
+		if len(buffer) >= self.batch_size and collection not in self.flushing:
+			self.track(self.loop.create_task(self.flush(collection)))
+
+	def track(self, future):
+		self.pending.add(future)
+		future.add_done_callback(self.pending.discard)
+
+	async def flush(self, collection):
+		docs = self.buffers.pop(collection, None)
+		if not docs:
+			return True
+
+		self.buffered -= len(docs)
+		self.flushing.add(collection)
+		try:
+			await self.ensure_indexes(collection)
+			await self.mongo_db[collection].insert_many(docs, ordered=False)
+			return True
+		except Exception as e:
+			log.info('Could not write {} logs to {}, spilling them'.format(
+				len(docs),
+				collection
+			))
+			log.info(e)
+			await self.spill(collection, docs)
+			return False
+		finally:
+			self.flushing.discard(collection)
+
+	async def ensure_indexes(self, collection):
+		if collection in self.indexed:
+			return
+		for index in LOG_INDEXES:
+			await self.mongo_db[collection].create_index(index)
+		self.indexed.add(collection)
+
+	async def flush_all(self):
+		ok = True
+		for collection in list(self.buffers):
+			ok = await self.flush(collection) and ok
+		return ok
+
+	def spill(self, collection, docs):
+		return self.loop.run_in_executor(self.spill_pool, self.write_spill,
+										 collection, docs)
+
+	def write_spill(self, collection, docs):
+		with open(self.spill_path, 'a') as f:
+			for doc in docs:
+				# insert_many sets the _id, keep it separately as a string
+				doc = dict(doc)
+				doc_id = doc.pop('_id', None)
+				entry = {'collection' : collection, 'doc' : doc}
+				if doc_id is not None:
+					entry['id'] = str(doc_id)
+				f.write(json.dumps(entry, default=str))
+				f.write('\n')
+
+	async def insert_ignoring_duplicates(self, collection, docs):
+		"""Inserts the docs, some of which may already be written"""
+		try:
+			await self.mongo_db[collection].insert_many(docs, ordered=False)
+		except BulkWriteError as e:
+			failed = [error['index'] for error in e.details['writeErrors']
+					  if error['code'] != DUPLICATE_KEY]
+			if failed:
+				log.info(e)
+				await self.spill(collection, [docs[i] for i in failed])
+
+	def read_replay(self):
+		"""Batches of the file to replay, None if there's nothing to replay
+
+		A replay file left by an interrupted replay goes first, the spill
+		file waits for the next one.
+
+		"""
+		replay_path = self.spill_path + '.replay'
+		if not os.path.exists(replay_path):
+			if not os.path.exists(self.spill_path):
+				return None
+			os.replace(self.spill_path, replay_path)
+
+		batches = {}
+		with open(replay_path) as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# Torn by a crash while spilling
+					log.info('Skipping a bad line of {}'.format(replay_path))
+					continue
+				doc = entry['doc']
+				if 'id' in entry:
+					doc['_id'] = ObjectId(entry['id'])
+				batches.setdefault(entry['collection'], []).append(doc)
+		return batches
+
+	async def replay(self):
+		"""Writes the spilled logs back to Mongo"""
+		# Run by the spill thread, so no spill is half written meanwhile
+		batches = await self.loop.run_in_executor(self.spill_pool,
+												  self.read_replay)
+		if batches is None:
+			return
+
+		log.info('Replaying spilled logs of {} collections'.format(len(batches)))
+		for collection, docs in batches.items():
+			for i in range(0, len(docs), self.batch_size):
+				batch = docs[i:i + self.batch_size]
+				try:
+					await self.insert_ignoring_duplicates(collection, batch)
+				except Exception as e:
+					log.info(e)
+					await self.spill(collection, batch)
+		await self.loop.run_in_executor(self.spill_pool, os.remove,
+										self.spill_path + '.replay')
+
+	async def flush_loop(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			try:
+				if await self.flush_all():
+					await self.replay()
+			except Exception as e:
+				log.info('An error occured while flushing the logs')
+				log.info(e)
+
+	async def close(self):
+		"""Drains the buffers, spilling whatever can't be written"""
+		self.task.cancel()
+		while self.pending:
+			await asyncio.gather(*self.pending, return_exceptions=True,
+								 loop=self.loop)
+		await self.flush_all()
+		while self.pending:
+			await asyncio.gather(*self.pending, return_exceptions=True,
+								 loop=self.loop)
+		self.spill_pool.shutdown(wait=False)
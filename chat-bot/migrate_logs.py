@@ -0,0 +1,83 @@
+"""Moves the per server/day/channel log collections to monthly collections
+
+Old collections are named `{server_id}:{date}:{channel}`. Their messages
+are copied (with their `server` and `channel` fields set) into the
+`messages:YYYY-MM` collection of their timestamp. With --drop, a
+collection is dropped once it has been copied. Messages keep their _id,
+so running the migration again (after a crash, or without --drop) skips
+the messages already copied.
+
+	MONGO_URL=mongodb://... python migrate_logs.py [--drop]
+
+"""
+import os
+import re
+import sys
+import logging
+import pymongo
+from pymongo.errors import BulkWriteError
+from log_writer import LOG_INDEXES, DUPLICATE_KEY, month_collection
+
+log = logging.getLogger('discord')
+
+OLD_COLLECTION = re.compile(r'^([0-9]+):([0-9]+-[0-9]+-[0-9]+):(.+)$')
+BATCH_SIZE = 1000
+
+
+def migrate_collection(db, name, server_id, channel, indexed):
+	batches = {}
+	count = 0
+
+	def flush(collection):
+		docs = batches.pop(collection)
+		if collection not in indexed:
+			for index in LOG_INDEXES:
+				db[collection].create_index(index)
+			indexed.add(collection)
+		try:
+			db[collection].insert_many(docs, ordered=False)
+		except BulkWriteError as e:
+			# Copied by an earlier run
+			if any(error['code'] != DUPLICATE_KEY
+				   for error in e.details['writeErrors']):
+				raise
+
+	for doc in db[name].find():
+		doc['server'] = server_id
+		doc['channel'] = channel
+		collection = month_collection(doc.get('timestamp', 0))
+		batch = batches.setdefault(collection, [])
+		batch.append(doc)
+		count += 1
+		if len(batch) >= BATCH_SIZE:
+			flush(collection)
+
+	for collection in list(batches):
+		flush(collection)
+
+	return count
+
+
+def migrate(db, drop=False):
+	indexed = set()
+	names = [name for name in db.collection_names()
+			 if OLD_COLLECTION.match(name)]
+	log.info('Migrating {} collections'.format(len(names)))
+
+	total = 0
+	for i, name in enumerate(names):
+		server_id, date, channel = OLD_COLLECTION.match(name).groups()
+		count = migrate_collection(db, name, server_id, channel, indexed)
+		total += count
+		if drop:
+			db.drop_collection(name)
+		log.info('[{}/{}] {} : {} messages'.format(i + 1, len(names), name,
+												   count))
+
+	log.info('Migrated {} messages'.format(total))
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	mongo = pymongo.MongoClient(os.getenv('MONGO_URL'))
+	migrate(mongo.logs, drop='--drop' in sys.argv)
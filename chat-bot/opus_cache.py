@@ -0,0 +1,390 @@
+"""Local cache of pre-encoded Opus audio
+
+Tracks played at least `PLAY_THRESHOLD` times are transcoded once to Opus
+frames and stored under the SHA-256 of the encoded frames, so the same
+audio coming from different urls is only stored once:
+
+- `{digest}.opus` is a sequence of frames, each one prefixed with its
+  length as a big endian unsigned short
+- `index.json` maps a track url to its digest, size and last use
+
+Cached tracks are played from a memory map straight to the voice socket,
+without ffmpeg nor encoding. The least recently used tracks are evicted
+once the files go over the disk budget.
+
+Every shard of every bot process shares the directory. The index is
+only changed under an exclusive lock on `index.lock`, after reading
+what the others saved, so the budget holds for all of them together.
+The index is read and written by a thread of its own, and the last uses
+of the tracks are saved every `SYNC_INTERVAL` seconds so the others
+don't evict what is about to be played.
+
+"""
+import os
+import json
+import time
+import asyncio
+import mmap
+import fcntl
+import struct
+import hashlib
+import logging
+import tempfile
+import subprocess
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from opus_stream import OpusPlayer, ffmpeg_args, read_packets
+
+log = logging.getLogger('discord')
+
+OPUS_CACHE_DIR = os.getenv('OPUS_CACHE_DIR', 'opus_cache')
+# Disk budget in megabytes
+OPUS_CACHE_BUDGET = int(os.getenv('OPUS_CACHE_BUDGET') or 2048)
+OPUS_CACHE_WORKERS = int(os.getenv('OPUS_CACHE_WORKERS') or 1)
+PLAY_THRESHOLD = 2
+# Tracks longer than that are streamed, never cached
+MAX_DURATION = 60 * 20
+# Play counts of the tracks that aren't cached yet
+MAX_COUNTED = 4096
+# A temporary file an encoding hasn't written to for that long is left
+# over from a crash
+STALE_TMP_AGE = 3600 * 6
+SYNC_INTERVAL = 5
+LENGTH = struct.Struct('>H')
+
+
+def encode_track(stream_url, path, volume=1.0, before_options=''):
+	"""Transcodes a stream to length-prefixed Opus frames
+
+	Runs in a worker thread, ffmpeg does the encoding. Returns the digest
+	and the size.
+
+	"""
+	args = ffmpeg_args(stream_url, volume, before_options=before_options)
+	process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+							   stdout=subprocess.PIPE)
+	digest = hashlib.sha256()
+	size = 0
+	try:
+		with open(path, 'wb') as out:
+			for frame in read_packets(process.stdout):
+				chunk = LENGTH.pack(len(frame)) + frame
+				digest.update(chunk)
+				out.write(chunk)
+				size += len(chunk)
+	finally:
+		process.stdout.close()
+		code = process.wait()
+
+	if code != 0:
+		raise RuntimeError('ffmpeg exited with {}'.format(code))
+	return digest.hexdigest(), size
+
+
+class OpusFilePlayer(OpusPlayer):
+	"""Sends the frames of a cached track from a memory map"""
+
+	def __init__(self, path, voice, after=None):
+		with open(path, 'rb') as f:
+			# An empty file can't be mapped
+			if os.fstat(f.fileno()).st_size:
+				self.frames = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				self.frames = b''
+		super().__init__(voice, self.frames, after)
+
+	def packets(self):
+		offset = 0
+		while offset + LENGTH.size <= len(self.frames):
+			length, = LENGTH.unpack_from(self.frames, offset)
+			offset += LENGTH.size
+			yield self.frames[offset:offset + length]
+			offset += length
+
+	def close(self):
+		if self.frames:
+			self.frames.close()
+
+
+class OpusCache():
+
+	def __init__(self, loop, stats, cache_dir=OPUS_CACHE_DIR,
+				 budget=OPUS_CACHE_BUDGET * 1024 * 1024,
+				 workers=OPUS_CACHE_WORKERS):
+		self.loop = loop
+		self.stats = stats
+		self.cache_dir = cache_dir
+		self.budget = budget
+		self.index_path = os.path.join(cache_dir, 'index.json')
+		self.lock_path = os.path.join(cache_dir, 'index.lock')
+		# Modification time of the index when it was last read or saved
+		self.index_mtime = None
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		# Reads and writes the index, one thing at a time
+		self.index_pool = ThreadPoolExecutor(max_workers=1)
+		# url -> {'digest', 'size', 'last_used'}, least recently used first
+		self.entries = OrderedDict()
+		# url -> last use not saved yet
+		self.touched = {}
+		self.plays = OrderedDict()
+		self.encoding = set()
+		self.hits = 0
+		self.misses = 0
+		os.makedirs(cache_dir, exist_ok=True)
+		# Before the loop runs, the others only hold the lock briefly
+		self.update(*self.sync(clean=True))
+		self.task = loop.create_task(self.sync_loop())
+
+	def path(self, digest):
+		return os.path.join(self.cache_dir, digest + '.opus')
+
+	@contextmanager
+	def locked(self):
+		"""Holds the index lock of the cache directory"""
+		with open(self.lock_path, 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def index_stat(self):
+		try:
+			return os.stat(self.index_path).st_mtime_ns
+		except FileNotFoundError:
+			return None
+
+	def read_index(self):
+		"""The saved entries and the mtime of the index"""
+		try:
+			mtime = self.index_stat()
+			with open(self.index_path) as index:
+				return json.load(index), mtime
+		except (FileNotFoundError, ValueError):
+			return {}, None
+
+	def sync(self, touched=None, added=None, clean=False):
+		"""Merges our changes into the saved index, in the index thread
+
+		`touched` maps urls to their last use, `added` is the url, entry
+		and encoded file of a new track. Returns the merged entries and
+		the mtime of the index.
+
+		"""
+		with self.locked():
+			entries, _ = self.read_index()
+			for url, last_used in (touched or {}).items():
+				if url in entries:
+					entries[url]['last_used'] = max(entries[url]['last_used'],
+													last_used)
+			if added:
+				url, entry, tmp_path = added
+				path = self.path(entry['digest'])
+				if os.path.exists(path):
+					os.remove(tmp_path)
+				else:
+					os.replace(tmp_path, path)
+				entries[url] = entry
+
+			entries = OrderedDict(sorted(entries.items(),
+										 key=lambda item: item[1]['last_used']))
+			if clean:
+				self.clean(entries)
+			self.evict(entries)
+
+			tmp_path = self.index_path + '.tmp'
+			with open(tmp_path, 'w') as index:
+				json.dump(entries, index)
+			os.replace(tmp_path, self.index_path)
+			return entries, self.index_stat()
+
+	def reload(self):
+		"""The saved index if it changed since `index_mtime`, or None"""
+		mtime = self.index_stat()
+		if mtime == self.index_mtime:
+			return None
+		return self.read_index()
+
+	def update(self, entries, mtime):
+		"""Takes the entries read by the index thread, on the loop"""
+		for url, last_used in self.touched.items():
+			if url in entries:
+				entries[url]['last_used'] = max(entries[url]['last_used'],
+												last_used)
+				entries.move_to_end(url)
+		self.entries = OrderedDict(entries)
+		self.index_mtime = mtime
+
+	async def run_index(self, func, *args, **kwargs):
+		return await self.loop.run_in_executor(
+			self.index_pool, lambda: func(*args, **kwargs)
+		)
+
+	async def sync_loop(self):
+		"""Saves the last uses and picks up what the others changed"""
+		while True:
+			await asyncio.sleep(SYNC_INTERVAL)
+			try:
+				if self.touched:
+					touched, self.touched = self.touched, {}
+					self.update(*await self.run_index(self.sync, touched))
+				else:
+					index = await self.run_index(self.reload)
+					if index:
+						entries, mtime = index
+						entries = OrderedDict(sorted(
+							entries.items(),
+							key=lambda item: item[1]['last_used']
+						))
+						self.update(entries, mtime)
+			except Exception as e:
+				log.info('An error occured while syncing the Opus cache')
+				log.info(e)
+
+	def clean(self, entries):
+		"""Removes what interrupted encodings and evictions left behind
+
+		The temporary files of running encodings, in any process, are
+		still being written to.
+
+		"""
+		for url, entry in list(entries.items()):
+			if not os.path.exists(self.path(entry['digest'])):
+				del entries[url]
+
+		digests = set(entry['digest'] for entry in entries.values())
+		now = time.time()
+		for name in os.listdir(self.cache_dir):
+			path = os.path.join(self.cache_dir, name)
+			try:
+				if name.endswith('.opus') and \
+						name[:-len('.opus')] not in digests:
+					os.remove(path)
+				elif name.endswith('.tmp') and \
+						now - os.path.getmtime(path) > STALE_TMP_AGE:
+					os.remove(path)
+			except FileNotFoundError:
+				continue
+
+	def __contains__(self, url):
+		return url in self.entries
+
+	@property
+	def size(self):
+		sizes = {entry['digest'] : entry['size']
+				 for entry in self.entries.values()}
+		return sum(sizes.values())
+
+	def touch(self, url):
+		entry = self.entries[url]
+		entry['last_used'] = self.touched[url] = time.time()
+		self.entries.move_to_end(url)
+
+	def path_of(self, url):
+		"""Path of the cached frames of a track, which is about to be
+		played, or None"""
+		entry = self.entries.get(url)
+		if entry is None:
+			return None
+		self.touch(url)
+		return self.path(entry['digest'])
+
+	def lookup(self, url):
+		"""Path of the cached frames of a track, None on a miss"""
+		entry = self.entries.get(url)
+		if entry:
+			self.hits += 1
+			self.touch(url)
+		else:
+			self.misses += 1
+		self.stats.incr('RickBot.music.opus_cache',
+						tags=['result:{}'.format('hit' if entry else 'miss')])
+		return self.path(entry['digest']) if entry else None
+
+	def played(self, url, stream_url, duration=None, **encode_options):
+		"""Counts a streamed play and caches the track once it's popular"""
+		if url in self.entries or url in self.encoding:
+			return
+		if duration is None or duration > MAX_DURATION:
+			return
+
+		plays = self.plays.pop(url, 0) + 1
+		if plays < PLAY_THRESHOLD:
+			self.plays[url] = plays
+			if len(self.plays) > MAX_COUNTED:
+				self.plays.popitem(last=False)
+			return
+
+		self.encoding.add(url)
+		self.loop.create_task(self.add(url, stream_url, encode_options))
+
+	async def add(self, url, stream_url, encode_options):
+		# Unique, another process may be encoding the same url
+		fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+		os.close(fd)
+		start = time.time()
+		try:
+			digest, size = await self.loop.run_in_executor(
+				self.pool, lambda: encode_track(stream_url, tmp_path,
+												**encode_options)
+			)
+			if not size:
+				raise RuntimeError('ffmpeg gave no audio')
+			entry = {'digest' : digest, 'size' : size,
+					 'last_used' : time.time()}
+			touched, self.touched = self.touched, {}
+			self.update(*await self.run_index(self.sync, touched,
+											  (url, entry, tmp_path)))
+			self.stats.timing('RickBot.music.opus_encode',
+							  (time.time() - start) * 1000)
+		except Exception as e:
+			log.info('Could not cache {}'.format(url))
+			log.info(e)
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		finally:
+			self.encoding.discard(url)
+
+	def evict(self, entries):
+		"""Removes the least recently used tracks until under the budget
+
+		Only called with the lock held, on the index all processes saved.
+
+		"""
+		sizes = {entry['digest'] : entry['size'] for entry in entries.values()}
+		size = sum(sizes.values())
+		while size > self.budget and len(entries) > 1:
+			url, entry = entries.popitem(last=False)
+			digest = entry['digest']
+			# Other urls can have the same content
+			if any(e['digest'] == digest for e in entries.values()):
+				continue
+			size -= entry['size']
+			# A player can keep reading its memory map after the unlink
+			try:
+				os.remove(self.path(digest))
+			except FileNotFoundError:
+				pass
+
+	def info(self):
+		lookups = self.hits + self.misses
+		return {
+			'tracks' : len(self.entries),
+			'files' : len(set(entry['digest']
+							  for entry in self.entries.values())),
+			'size' : self.size,
+			'budget' : self.budget,
+			'hits' : self.hits,
+			'misses' : self.misses,
+			'hit_rate' : self.hits / lookups if lookups else 0.0,
+			'encoding' : len(self.encoding)
+		}
+
+	async def close(self):
+		self.task.cancel()
+		self.pool.shutdown(wait=False)
+		touched, self.touched = self.touched, {}
+		await self.run_index(self.sync, touched)
+		self.index_pool.shutdown(wait=False)
@@ -0,0 +1,156 @@
+"""Players sending already encoded Opus packets
+
+discord.py's ffmpeg player reads PCM from ffmpeg, scales it in Python when
+the volume isn't 1 and encodes every 20ms frame in the bot's process.
+Here ffmpeg applies the gain in its filter graph and encodes to Opus
+itself (or copies the audio when the source already is Opus), and the
+player only demuxes the Ogg pages and forwards the packets.
+
+"""
+import time
+import logging
+import subprocess
+
+from discord.voice_client import StreamPlayer
+
+log = logging.getLogger('discord')
+
+SAMPLING_RATE = 48000
+CHANNELS = 2
+SAMPLES_PER_FRAME = 960
+BITRATE = '128k'
+OGG_HEADER_SIZE = 27
+
+
+def packet_samples(packet):
+	"""Number of 48kHz samples in an Opus packet, from its TOC byte"""
+	toc = packet[0]
+	config = toc >> 3
+	if config < 12:
+		frame = (480, 960, 1920, 2880)[config % 4]
+	elif config < 16:
+		frame = (480, 960)[config % 2]
+	else:
+		frame = (120, 240, 480, 960)[config % 4]
+
+	code = toc & 3
+	if code == 0:
+		frames = 1
+	elif code < 3:
+		frames = 2
+	else:
+		frames = packet[1] & 0x3f
+	return frame * frames
+
+
+def read_packets(stream):
+	"""Yields the audio packets of an Ogg Opus stream"""
+	packet = b''
+	# OpusHead and OpusTags
+	headers = 2
+	while True:
+		header = stream.read(OGG_HEADER_SIZE)
+		if len(header) < OGG_HEADER_SIZE:
+			return
+		if header[:4] != b'OggS':
+			raise ValueError('Invalid Ogg page')
+
+		segments = stream.read(header[26])
+		data = stream.read(sum(segments))
+		offset = 0
+		for length in segments:
+			packet += data[offset:offset + length]
+			offset += length
+			# A packet goes on in the next segment when this one is full
+			if length == 255:
+				continue
+			if headers:
+				headers -= 1
+			elif packet:
+				yield packet
+			packet = b''
+
+
+def ffmpeg_args(source, volume=1.0, passthrough=False, before_options=''):
+	"""ffmpeg command writing a source to stdout as Ogg Opus"""
+	args = ['ffmpeg'] + before_options.split() + ['-i', source, '-vn',
+												  '-map', '0:a:0']
+	if passthrough:
+		args += ['-c:a', 'copy']
+	else:
+		if volume != 1.0:
+			args += ['-af', 'volume={}'.format(volume)]
+		args += ['-c:a', 'libopus', '-b:a', BITRATE, '-frame_duration', '20',
+				 '-application', 'audio', '-ar', str(SAMPLING_RATE),
+				 '-ac', str(CHANNELS)]
+	return args + ['-f', 'ogg', '-page_duration', '100000',
+				   '-loglevel', 'warning', 'pipe:1']
+
+
+class OpusPlayer(StreamPlayer):
+	"""Paces and sends the packets yielded by `packets()` without encoding"""
+
+	def __init__(self, voice, stream=None, after=None):
+		super().__init__(stream, voice.encoder, voice._connected,
+						 voice.play_audio, after)
+		self.voice = voice
+
+	def packets(self):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+	def _do_run(self):
+		self.loops = 0
+		self._start = time.time()
+		elapsed = 0.0
+		try:
+			for packet in self.packets():
+				if self._end.is_set():
+					return
+				if not self._resumed.is_set():
+					self._resumed.wait()
+					# Don't rush the packets missed while paused
+					self._start = time.time() - elapsed
+				if not self._connected.is_set():
+					break
+
+				self.loops += 1
+				self.player(packet, encode=False)
+				samples = packet_samples(packet)
+				# play_audio moves the timestamp by one 20ms frame
+				if samples != SAMPLES_PER_FRAME:
+					self.voice.timestamp = (self.voice.timestamp + samples -
+											SAMPLES_PER_FRAME) % 2 ** 32
+				elapsed += samples / SAMPLING_RATE
+				time.sleep(max(0, self._start + elapsed - time.time()))
+		finally:
+			self.close()
+
+		if not self._end.is_set():
+			self.stop()
+
+
+class FFmpegOpusPlayer(OpusPlayer):
+
+	def __init__(self, voice, source, volume=1.0, passthrough=False,
+				 before_options='', after=None):
+		args = ffmpeg_args(source, volume, passthrough, before_options)
+		self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+										stdout=subprocess.PIPE)
+		super().__init__(voice, self.process.stdout, after)
+
+	def packets(self):
+		return read_packets(self.process.stdout)
+
+	def close(self):
+		if self.process.poll() is None:
+			self.process.kill()
+		self.process.communicate()
+
+	def stop(self):
+		# Unblocks the player thread waiting on ffmpeg's output
+		if self.process.poll() is None:
+			self.process.kill()
+		super().stop()
@@ -1,5 +1,6 @@
 import inspect
 import logging
+from router import CommandRouter
 
 logs = logging.getLogger('discord')
 
@@ -29,11 +30,13 @@ class Plugin(object, metaclass=PluginMount):
 		for name, member in inspect.getmembers(self):
 			# Register the commands.
 			if hasattr(member, '_is_command'):
-				self.command[member.__name__] = member
+				self.commands[member.__name__] = member
 			# Register the bg_tasks.
 			if hasattr(member, '_bg_task'):
 				self.bg_tasks[member.__name__] = member
 				self.RickBot.loop.create_task(member())
+		# Index the commands by their pattern
+		self.router = CommandRouter(self.commands.values())
 		logs.info("Registered {} commands / {} bg tasks".format(
 			len(self.commands)
 			len(self.bg_tasks)
@@ -45,8 +48,15 @@ class Plugin(object, metaclass=PluginMount):
 	async def on_ready(self):
 		pass
 
+	async def on_shutdown(self):
+		pass
+
+	def invalidate(self, server_id=None):
+		"""Drops the settings cached for a server (or for every server)"""
+		pass
+
 	async def _on_message(self, message):
-		for command_name, func in self.commands.items():
+		for func in self.router.match(message.content):
 			await func(message)
 		await self.on_message(message)
 
@@ -1,42 +1,166 @@
+import asyncio
+import time
 import logging
 import aioredis
 from plugin import Plugin
 
 log = logging.getLogger('discord')
 
+INVALIDATION_CHANNEL = 'plugins.invalidate'
+# Buff purchases aren't published, cached lists are refreshed after that
+CACHE_TTL = 300
+
+
 class PluginManager():
 
 	def __init__(self, RickBot):
 		self.RickBot = RickBot
 		self.db = RickBot.db
 		self.RickBot.plugins = []
+		# server_id -> (plugins, expires_at)
+		self.cache = {}
+		# event -> plugins overriding its handler
+		self.handlers = {}
+		self.skipped_handlers = 0
 
 	def load(self, plugin):
 		log.info('Loading plugin {}.'.format(plugin.__name__))
 		plugin_instance = plugin(self.RickBot)
 		self.RickBot.plugins.append(plugin_instance)
+		for event in self.overridden_events(plugin_instance):
+			self.handlers.setdefault(event, set()).add(plugin_instance)
 		log.info('Plugin {} loaded.'.format(plugin.__name__))
 
 	def load_all(self):
 		for plugin in Plugin.plugins:
 			self.load(plugin)
 
+	def overridden_events(self, plugin):
+		"""Lists the event handlers a plugin actually implements"""
+		events = []
+		for name in dir(Plugin):
+			if not name.startswith('on_'):
+				continue
+			if getattr(type(plugin), name) is not getattr(Plugin, name):
+				events.append(name)
+
+		# Commands are run from _on_message
+		if 'on_message' in events or plugin.commands:
+			events.append('_on_message')
+
+		return events
+
+	def invalidate(self, server_id=None):
+		"""Drops the cached plugin list of a server (or of every server)"""
+		if server_id is None:
+			self.cache.clear()
+		else:
+			self.cache.pop(server_id, None)
+
 	async def get_all(self, server):
-		try:
-			plugin_names = await self.db.redis.smembers('plugins:{}'.format(server.id))
-			plugins = []
-			for plugin in self.RickBot.plugins:
-				if plugin.is_global:
-					plugins.append(plugin)
-				if plugin.__class__.__name__ in plugin_names:
-					if hasattr(plugin, 'buff_name'):
-						buff_ok = await self.db.redis.get('buffs:{}:{}'.format(server.id,
-																			   plugin.buff_name))
-						if not buff_ok:
-							continue
-
-					plugins.append(plugin)
+		cached = self.cache.get(server.id)
+		if cached:
+			plugins, expires_at = cached
+			if expires_at > time.time():
 				return plugins
-			except aioredis.errors.ConnectionClosedError as e:
-				await self.db.create()
-				return await self.get_all(server)
\ No newline at end of file
+
+		try:
+			plugins, expires_at = await self.fetch_all(server)
+		except aioredis.errors.ConnectionClosedError as e:
+			await self.db.create()
+			plugins, expires_at = await self.fetch_all(server)
+
+		self.cache[server.id] = (plugins, expires_at)
+		return plugins
+
+	async def get_interested(self, server, event):
+		"""Returns the enabled plugins that implement the event handler"""
+		plugins = await self.get_all(server)
+		handlers = self.handlers.get(event, ())
+		interested = [plugin for plugin in plugins if plugin in handlers]
+
+		skipped = len(plugins) - len(interested)
+		if skipped:
+			self.skipped_handlers += skipped
+			self.RickBot.stats.incr('RickBot.skipped_handlers', skipped)
+
+		return interested
+
+	async def fetch_all(self, server):
+		"""Resolves the enabled plugins of a server from the DB
+
+		Returns the plugins along with the time at which the list must be
+		fetched again: when the first buff expires, at most CACHE_TTL.
+
+		"""
+		plugin_names = await self.db.redis.smembers('plugins:{}'.format(server.id))
+		plugins = []
+		expires_at = time.time() + CACHE_TTL
+		for plugin in self.RickBot.plugins:
+			if plugin.is_global:
+				plugins.append(plugin)
+				continue
+			if plugin.__class__.__name__ not in plugin_names:
+				continue
+			if hasattr(plugin, 'buff_name'):
+				buff_key = 'buffs:{}:{}'.format(server.id, plugin.buff_name)
+				buff_ok = await self.db.redis.get(buff_key)
+				if not buff_ok:
+					continue
+				ttl = await self.db.redis.ttl(buff_key)
+				if ttl > 0:
+					buff_expires_at = time.time() + ttl
+					if buff_expires_at < expires_at:
+						expires_at = buff_expires_at
+
+			plugins.append(plugin)
+
+		return plugins, expires_at
+
+	def invalidate_data(self, plugin_name, server_id=None):
+		"""Tells a plugin (or every plugin) to drop its cached settings"""
+		for plugin in self.RickBot.plugins:
+			if plugin_name is None or plugin.__class__.__name__ == plugin_name:
+				plugin.invalidate(server_id)
+
+	async def listen_invalidations(self):
+		"""Drops cached data when the website publishes a change
+
+		A message is either a server id, for its plugin list, or
+		`PluginName:server_id` for the settings a plugin cached. A plugin
+		doesn't get the events of the servers it's disabled on, so a new
+		plugin list also drops what the plugins cached for the server.
+
+		"""
+		while True:
+			redis = None
+			try:
+				redis = await aioredis.create_redis(
+					self.db.redis_address,
+					encoding='utf-8'
+				)
+				channel, = await redis.subscribe(INVALIDATION_CHANNEL)
+				# Anything published while we weren't listening is lost
+				self.invalidate()
+				self.invalidate_data(None)
+				while await channel.wait_message():
+					message = await channel.get(encoding='utf-8')
+					log.debug('Invalidating {}'.format(message))
+					plugin_name, _, server_id = message.rpartition(':')
+					if plugin_name:
+						self.invalidate_data(plugin_name, server_id)
+					else:
+						self.invalidate(server_id or None)
+						self.invalidate_data(None, server_id or None)
+			except Exception as e:
+				log.info('Plugins invalidation listener failed, retrying')
+				log.info(e)
+				self.invalidate()
+				self.invalidate_data(None)
+			finally:
+				# Or every retry leaks a connection
+				if redis is not None:
+					redis.close()
+					await redis.wait_closed()
+
+			await asyncio.sleep(1)
@@ -1,4 +1,10 @@
 from plugin import Plugin
+from decorators import bg_task
+from log_writer import LogWriter, month_collection
+from log_archive import LogArchiver, day_of
+from log_search import JournalWriter
+from scripts import Script
+import os
 import time
 import logging
 from datetime import datetime
@@ -6,10 +12,134 @@ import json
 
 logger = logging.getLogger('discord')
 
+LOGS_ARCHIVE_DIR = os.getenv('LOGS_ARCHIVE_DIR', 'logs_archive')
+LOGS_ARCHIVE_DAYS = int(os.getenv('LOGS_ARCHIVE_DAYS') or 30)
+LOGS_INDEX_DIR = os.getenv('LOGS_INDEX_DIR', 'logs_index')
+MEMBER_LOGS_RETENTION = int(os.getenv('MEMBER_LOGS_RETENTION') or 1000)
+
+# Gives a member record the next id, pushes it and trims the list in one
+# go, so concurrent events can't push their ids out of order nor leave
+# the list untrimmed
+#
+# KEYS: member_logs, member_logs:seq
+# ARGV: JSON record without its id, retention
+PUSH_MEMBER_LOG = Script("""
+local record = cjson.decode(ARGV[1])
+record['id'] = redis.call('INCR', KEYS[2])
+redis.call('LPUSH', KEYS[1], cjson.encode(record))
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+return record['id']
+""")
+
+# Moves the member events of the old `logs` list of a server, like
+# "1500000000.0 Rick#1234 joined the server.", after its member_logs
+# records. The records are numbered again from the head so the ids still
+# decrease by one down the list. Lines that don't parse are dropped.
+#
+# KEYS: member_logs, member_logs:seq, logs
+# ARGV: retention
+MIGRATE_MEMBER_LOGS = Script("""
+local retention = tonumber(ARGV[1])
+local events = {['joined'] = 'join', ['left'] = 'leave',
+				['was banned from'] = 'ban', ['was unbanned from'] = 'unban'}
+
+local records = {}
+for _, record in ipairs(redis.call('LRANGE', KEYS[1], 0, retention - 1)) do
+	table.insert(records, cjson.decode(record))
+end
+local kept = #records
+
+for _, line in ipairs(redis.call('LRANGE', KEYS[3], 0, retention - 1)) do
+	if #records >= retention then
+		break
+	end
+	local timestamp, name, discriminator, what = string.match(line,
+		'^(%S+) (.+)#(%d+) (.-) the server%.$')
+	if timestamp and tonumber(timestamp) and events[what] then
+		table.insert(records, {
+			event = events[what],
+			timestamp = tonumber(timestamp),
+			user = {id = cjson.null, name = name,
+					discriminator = discriminator}
+		})
+	end
+end
+
+local top = (tonumber(redis.call('GET', KEYS[2])) or kept) + #records - kept
+redis.call('DEL', KEYS[1])
+for i, record in ipairs(records) do
+	record['id'] = top - i + 1
+	redis.call('RPUSH', KEYS[1], cjson.encode(record))
+end
+redis.call('SET', KEYS[2], top)
+redis.call('DEL', KEYS[3])
+return #records - kept
+""")
+
 class Logs(Plugin):
 
 	dank_name = "Logs"
 
+	def __init__(self, RickBot):
+		super().__init__(RickBot)
+		# Shards share the working directory, each one replays its own file
+		spill_path = 'logs.{}.spill'.format(RickBot.shard_id or 0)
+		self.writer = LogWriter(RickBot.db.mongo.logs, RickBot.loop,
+								spill_path=spill_path)
+		self.journal = JournalWriter(LOGS_INDEX_DIR, RickBot.loop)
+		self.archiver = LogArchiver(RickBot.db.mongo.logs, LOGS_ARCHIVE_DIR,
+									RickBot.loop)
+		# (server_id, channel) already added to today's logs index
+		self.indexed_date = None
+		self.indexed_channels = set()
+
+	async def on_shutdown(self):
+		await self.writer.close()
+		await self.journal.close()
+
+	@bg_task(3600)
+	async def archive_logs(self):
+		# Only one shard archives at a time
+		redis = self.RickBot.db.redis
+		locked = await redis.set('Logs.archive_lock', '1', expire=3600 * 6,
+								 exist=redis.SET_IF_NOT_EXIST)
+		if not locked:
+			return
+		try:
+			# Whole UTC days only, so a channel's day is archived in one go
+			day = 3600 * 24
+			cutoff = (int(time.time()) // day - LOGS_ARCHIVE_DAYS) * day
+			await self.archiver.run(cutoff)
+		finally:
+			await redis.delete('Logs.archive_lock')
+
+	@bg_task(3600 * 24)
+	async def migrate_legacy_logs(self):
+		"""Moves the `logs` lists member events were pushed on before to
+		member_logs, keeping the last MEMBER_LOGS_RETENTION events"""
+		redis = self.RickBot.db.redis
+		if await redis.get('Logs.legacy_logs_migrated'):
+			return
+		cursor, count = 0, 0
+		while True:
+			cursor, keys = await redis.scan(cursor, match='Logs.*:logs',
+											count=1000)
+			for key in keys:
+				if isinstance(key, bytes):
+					key = key.decode('utf-8')
+				# Logs.{server_id}:logs
+				namespace = key[:-len('logs')]
+				count += await MIGRATE_MEMBER_LOGS(
+					redis,
+					keys=[namespace + 'member_logs',
+						  namespace + 'member_logs:seq', key],
+					args=[MEMBER_LOGS_RETENTION]
+				)
+			if not cursor:
+				break
+		await redis.set('Logs.legacy_logs_migrated', '1')
+		logger.info('Migrated {} legacy member events'.format(count))
+
 	async def get_commands(self, server):
 		commands = [
 			{
@@ -30,84 +160,89 @@ class Logs(Plugin):
 		author = message.author
 		timestamp = time.mktime(message.timestamp.timetuple()) + message.timestamp.microsecond / 1E6
 		msg = {
+			"id" : message.id,
+			"server" : message.server.id,
+			"channel" : message.channel.name,
+			"channel_id" : message.channel.id,
 			"author":{
 					"id" : author.id,
 					"name" : author.name,
 					"discriminator" : author.discriminator,
 					"avatar" : author.avatar
 				},
-			"content" : message.content
+			"content" : message.content,
 			"clean_content" : message.clean_content,
 			"timestamp" : timestamp,
 			"attachments" : message.attachments
 		}
-		storage = await self.get_storage(message.server)
-		date = now.strftime("%Y-%m-%d %H:%M:%S UTC")
 		date = '{}-{}-{}'.format(now.year, now.month, now.day)
 		channel = message.channel.name
-		# Adding the date to the list of logs
-		await storage.sadd('message_logs', date)
-		# Adding the channel to the list of today's logs
-		await storage.sadd('message_logs:{}'.format(date), channel)
-		# Adding the message to the mongo logs
-		db = self.rickbot.db.mongo.logs
-		collection = db['{}:{}:{}'.format(message.server.id, date, channel)]
-		await collection.insert(msg)
+		if date != self.indexed_date:
+			self.indexed_date = date
+			self.indexed_channels.clear()
+
+		if (message.server.id, channel) not in self.indexed_channels:
+			storage = await self.get_storage(message.server)
+			# Adding the date to the list of logs
+			await storage.sadd('message_logs', date)
+			# Adding the channel to the list of today's logs
+			await storage.sadd('message_logs:{}'.format(date), channel)
+			self.indexed_channels.add((message.server.id, channel))
+		# Adding the message to this month's mongo logs
+		self.writer.add(month_collection(timestamp), msg)
+		# And to the search index
+		self.journal.add(message.server.id, msg, day_of(timestamp))
 		#await storage.lpush('message.logs:{}:{}'.format(date, channel), json.dumps(msg))
 
+	async def log_member_event(self, server, user, event):
+		"""Pushes a member event on the server's bounded member log
+
+		Every record gets an increasing id, newest records first, so a
+		page starting after a given id can be read without scanning.
+
+		"""
+		storage = await self.get_storage(server)
+		record = {
+			"event" : event,
+			"timestamp" : time.time(),
+			"user" : {
+				"id" : user.id,
+				"name" : user.name,
+				"discriminator" : user.discriminator
+			}
+		}
+		await storage.run_script(PUSH_MEMBER_LOG,
+								 keys=['member_logs', 'member_logs:seq'],
+								 args=[json.dumps(record), MEMBER_LOGS_RETENTION])
+
 	async def on_member_join(self, member):
-		storage = await self.get_storage(member.server)
-		log = "{} {}#{} joined the server.".format(
-			time.time(),
-			member.name,
-			member.discriminator
-		)
 		logger.info("{}#{} joined {}".format(
 			member.name,
 			member.discriminator,
 			member.server.name
 		))
-		await storage.lpush('logs', log)
+		await self.log_member_event(member.server, member, 'join')
 
 	async def on_member_remove(self, member):
-		storage = await self.get_storage(member.server)
-		log = "{} {}#{} left the server.".format(
-			time.time(),
-			member.name,
-			member.discriminator
-		)
 		logger.info("{}#{} left {}".format(
 			member.name,
 			member.discriminator,
 			member.server.name
 		))
-		await storage.lpush('logs', log)
+		await self.log_member_event(member.server, member, 'leave')
 
 	async def on_member_ban(self, member):
-		storage = await self.get_storage(member.server)
-		log = "{} {}#{} was banned from the server.".format(
-			time.time(),
-			member.name,
-			member.discriminator
-		)
 		logger.info("{}#{} was banned from {}".format(
 			member.name,
 			member.discriminator,
 			member.server.name
 		))
-		await storage.lpush('logs', log)
+		await self.log_member_event(member.server, member, 'ban')
 
 	async def on_member_unban(self, server, user):
-		storage = await self.get_storage(server)
-		log = "{} {}#{} was unbanned from the server.".format(
-			time.time(),
-			user.name,
-			user.discriminator
-		)
 		logger.info("{}#{} was unbanned from {}".format(
 			user.name,
 			user.discriminator,
 			server.name
 		))
-		await storage.lpush('logs', log)
-		
\ No newline at end of file
+		await self.log_member_event(server, user, 'unban')
@@ -1,31 +1,100 @@
 from plugin import Plugin
 from functools import wraps
 from decorators import command
+from purge import Purger
 
 import discord
 import logging
 import asycnio
 import re
-import calendar
 import time
 
 logs = logging.getLogger('discord')
 
+# Role events only reach the plugin while it's enabled, so the roles
+# allowed to moderate are read again at least that often
+AUTHORIZED_ROLES_TTL = 300
+
+
+def compile_banned_words(banned_words):
+	"""Builds a single regex matching any of the comma separated words
+
+	Words are casefolded and must not be surrounded by word characters,
+	the regex is meant to search a casefolded message.
+
+	"""
+	words = set(word.strip().casefold() for word in banned_words.split(','))
+	words.discard('')
+	if not words:
+		return None
+
+	# Longest first so that a word wins over its prefixes
+	alternatives = '|'.join(map(re.escape, sorted(words, key=len, reverse=True)))
+	return re.compile(r'(?<!\w)(?:{})(?!\w)'.format(alternatives))
+
 
 class Moderator(Plugin):
 
+	def __init__(self, RickBot):
+		super().__init__(RickBot)
+		# server_id -> compiled banned words (None if there aren't any)
+		self.banned_words_matchers = {}
+		# server_id -> {slowed channel_id : interval}
+		self.slowed_channels = {}
+		# server_id -> (ids of the roles allowed to moderate, expires_at)
+		self.authorized_roles = {}
+		self.purger = Purger(RickBot.http)
+
+	def invalidate(self, server_id=None):
+		if server_id is None:
+			self.banned_words_matchers.clear()
+			self.slowed_channels.clear()
+			self.authorized_roles.clear()
+		else:
+			self.banned_words_matchers.pop(server_id, None)
+			self.slowed_channels.pop(server_id, None)
+			self.authorized_roles.pop(server_id, None)
+
+	async def get_banned_words_matcher(self, server):
+		if server.id not in self.banned_words_matchers:
+			storage = await self.get_storage(server)
+			banned_words = await storage.get('banned_words')
+			self.banned_words_matchers[server.id] = compile_banned_words(
+				banned_words or ''
+			)
+		return self.banned_words_matchers[server.id]
+
+	async def get_authorized_roles(self, server):
+		"""Ids of the server roles allowed to moderate"""
+		authorized_roles, expires_at = self.authorized_roles.get(server.id,
+																 (None, 0))
+		if expires_at <= time.time():
+			storage = await self.get_storage(server)
+			role_names = await storage.smembers('roles')
+			authorized_roles = frozenset(
+				role.id for role in server.roles
+				if role.name in role_names or role.id in role_names or
+				role.permissions.manage_server
+			)
+			self.authorized_roles[server.id] = (
+				authorized_roles,
+				time.time() + AUTHORIZED_ROLES_TTL
+			)
+		return authorized_roles
+
 	async def check_auth(self, member):
 		# Is the author authorized?
-		storage = await self.get_storage(member.server)
-		role_names = await storage.smembers('roles')
-		authorized = False
-		for role in member.roles:
-			authorized = any([role.name in role_names,
-							  role.id in role_names,
-							  role.permissions.manage_server])
-			if authorized:
-				break
-		return authorized
+		authorized_roles = await self.get_authorized_roles(member.server)
+		return not authorized_roles.isdisjoint(role.id for role in member.roles)
+
+	async def on_server_role_create(self, server, role):
+		self.authorized_roles.pop(server.id, None)
+
+	async def on_server_role_update(self, server, role):
+		self.authorized_roles.pop(server.id, None)
+
+	async def on_server_role_delete(self, server, role):
+		self.authorized_roles.pop(server.id, None)
 
 	@command(pattern='^!clear ([0-9]*)$', db_check=True, db_name="clear",
 			 require_one_of_roles="roles")
@@ -34,20 +103,13 @@ class Moderator(Plugin):
 		if number < 1:
 			return
 
-		def predicate(message):
-			timestamp = calendar.timegm(message.timestamp.timetuple())
-			now = time.now
-
-			LIMIT = now - (3600 * 24 * 14)
-			return timestamp > LIMIT
-
-		deleted_messages = await self.rickbot.purge_from(
-			message.channel,
-			limit=number+1,
-			check=predicate
+		deleted = await self.purger.purge(
+			message.channel.id,
+			message.server.id,
+			limit=number+1
 		)
 
-		message_number = max(len(deleted_messages) - 1, 0)
+		message_number = max(deleted - 1, 0)
 
 		if message_number == 0:
 			resp = "Delete `no messages` :unamused: \n (I can't delete messages "\
@@ -61,9 +123,7 @@ class Moderator(Plugin):
 			message.channel,
 			resp
 		)
-		await asyncio.sleep(8)
-
-		await self.rickbot.delete_message(confirm_message)
+		self.RickBot.deleter.schedule(confirm_message, 8)
 
 	@command(pattern="^!clear <@!?([0-9])>$", db_check=True, db_name='clear',
 			 require_one_of_roles="roles")
@@ -75,18 +135,32 @@ class Moderator(Plugin):
 			return
 
 		def predicate(m):
-			timestamp = calendar.timegm(m.timestamp.timetuple())
-			now = time.time()
+			return m['author']['id'] == user.id or m['id'] == message.id
 
-			LIMIT = now - (3600 * 24 * 14)
-			return timestamp > LIMIT and (m.author.id == user.id or m == message)
+		# Streams the progress of long purges
+		status = {'message' : None, 'edited_at' : 0}
 
-		deleted_messages = await self.rickbot.purge_from(
-			message.channel,
-			check=predicate
+		async def progress(deleted):
+			if time.time() - status['edited_at'] < 2:
+				return
+			status['edited_at'] = time.time()
+			resp = "Deleting... `{} messages` :hourglass:".format(deleted)
+			if status['message']:
+				await self.rickbot.edit_message(status['message'], resp)
+			else:
+				status['message'] = await self.rickbot.send_message(
+					message.channel,
+					resp
+				)
+
+		deleted = await self.purger.purge(
+			message.channel.id,
+			message.server.id,
+			check=predicate,
+			progress=progress
 		)
 
-		message_number = max(len(deleted_messages) - 1, 0)
+		message_number = max(deleted - 1, 0)
 
 		if message_number == 0:
 			resp = "Deleted `no messages` :unamused: \n (I can't delete messages "\
@@ -96,13 +170,17 @@ class Moderator(Plugin):
 															 "" if message_number <\
 															    2 else "s")
 
-		confirm_message = await self.rickbot.send_message(
-			message.channel,
-			resp
-		)
-
-		await asyncio.sleep(8)
-		await self.rickbot.delete_message(confirm_message)
+		if status['message']:
+			confirm_message = await self.rickbot.edit_message(
+				status['message'],
+				resp
+			)
+		else:
+			confirm_message = await self.rickbot.send_message(
+				message.channel,
+				resp
+			)
+		self.RickBot.deleter.schedule(confirm_message, 8)
 
 	@command(pattern='^!mute <@!?[0-9]*)>$', db_check=True,
 			 require_one_of_roles="roles")
@@ -173,6 +251,7 @@ class Moderator(Plugin):
 			),
 			num
 		)
+		self.slowed_channels.pop(message.server.id, None)
 		await self.rickbot.send_message(
 			message.channel,
 			"{} is now in :snail: slewwwww mode :joy:! ({} seconds)".format(
@@ -183,27 +262,14 @@ class Moderator(Plugin):
 
 	@command(db_check=True, db_name="slowmode", require_one_of_roles="roles")
 	async def slowoff(self, message, args):
-		storage = await self.get_storage(message.server)
-		# Get the slowed_channels
-		slowed_channels = await storage.smembers('slowmode:channels')
+		slowed_channels = await self.get_slowed_channels(message.server)
 		if message.channel.id not in slowed_channels:
 			return
-		# Delete the channel from the slowed_channel
-		await storage.srem('slowmode:channel', message.channel.id)
-		# Get the slowed_members
-		slowed_members = await storage.smembers(
-			'slowmode:{}:slowed'.format(message.channel.id)
-		)
-		# Remove the slowed_members TTL
-		for user_id in slowed_members:
-			await storage.delete('slowmode:{}:slowed:{}'.format(
-				message.channel.id,
-				user_id
-			))
-		# Delete the list
-		await storage.delete('slowmode:{}:slowed'.format(
-			message.channel.id
-		))
+		storage = await self.get_storage(message.server)
+		# Delete the channel from the slowed_channels, the slowed members
+		# keys expire on their own
+		await storage.srem('slowmode:channels', message.channel.id)
+		self.slowed_channels.pop(message.server.id, None)
 		# Confirm message
 		await self.rickbot.send_message(
 			message.channel,
@@ -212,77 +278,60 @@ class Moderator(Plugin):
 			)
 		)
 
+	async def get_slowed_channels(self, server):
+		"""Returns the slowed channel ids of a server with their interval"""
+		slowed_channels = self.slowed_channels.get(server.id)
+		if slowed_channels is None:
+			storage = await self.get_storage(server)
+			slowed_channels = {}
+			for channel_id in await storage.smembers('slowmode:channels'):
+				interval = await storage.get(
+					'slowmode:{}:interval'.format(channel_id)
+				)
+				if interval:
+					slowed_channels[channel_id] = int(interval)
+			self.slowed_channels[server.id] = slowed_channels
+		return slowed_channels
+
 	async def slow_check(self, message):
-		storage = await self.get_storage(message.server)
+		# Check if the channel is in slowmode
+		slowed_channels = await self.get_slowed_channels(message.server)
+		interval = slowed_channels.get(message.channel.id)
+		if not interval:
+			return
 		# Check in case the user isn't auth
 		check = await self.check_auth(message.author)
 		if check:
 			return
-		# Check if the channel is already in slowmode
-		slowed_channels = await storage.smembers('slowmode:channels')
-		if message.channel.id not in slowed_channels:
-			return
-		# Grab a firm hold of the slowmode interval ;)
-		interval = await storage.get(
-			'slowmode:{}:interval'.format(message.channel.id)
-		)
-		if not interval:
-			return
 
-		# If the user is not in the slowed list...
-		# Maybe you should add that user to the slowed list?
-		await storage.sadd(
-			'slowmode:{}:slowed'.format(
-				message.channel.id
-			)
-			message.author.id
+		# The key only gets set if the user isn't already slowed
+		storage = await self.get_storage(message.server)
+		allowed = await storage.set(
+			'slowmode:{}:slowed:{}'.format(
+				message.channel.id,
+				message.author.id
+			),
+			'1',
+			expire = interval,
+			exist = storage.redis.SET_IF_NOT_EXIST
 		)
-		# Check if the user is slowed
-		slowed = await storage.get('slowmode:{}:slowed:{}'.format(
-			message.channel.id,
-			message.author.id)
-		) is not None
-
-		if slowed:
+		if not allowed:
 			await self.rickbot.delete_message(message)
-		else:
-			# Register a TTL key for the user...
-			await storage.set(
-				'slowmode:{}:slowed:{}'.format(
-					message.channel.id,
-					message.author.id
-				),
-				interval
-			)
-			await storage.expire(
-				'slowmode:{}:slowed:{}'.format(
-					message.channel.id,
-					message.author.id
-				),
-				int(interval)
-			)
 
 	async def banned_words(self, message):
-		storage = await self.get_storage(message.server)
-		banned_words = await storage.get('banned_words')
-		if banned_words:
-			banned_words = banned_words.split(',')
-		else:
-			banned_words = []
+		matcher = await self.get_banned_words_matcher(message.server)
+		if matcher is None:
+			return
 
-		words = list(map(lambda w: w.lower(), message.content.split()))
-		for banned_word in banned_words:
-			if banned_word.lower() in words:
-				await self.rickbot.delete_message(message)
-				msg = await self.rickbot.send_message(
-					message.channel,
-					"{}, **WATCH YOUR LANGUAGE!!!** :rage:".format(
-						message.author.mention
-					)
+		if matcher.search(message.content.casefold()):
+			await self.rickbot.delete_message(message)
+			msg = await self.rickbot.send_message(
+				message.channel,
+				"{}, **WATCH YOUR LANGUAGE!!!** :rage:".format(
+					message.author.mention
 				)
-				await asyncio.sleep(3)
-				await self.rickbot.delete_message(msg)
-				return
+			)
+			self.RickBot.deleter.schedule(msg, 3)
 
 	async def on_message_edit(self, before, after):
 		await self.banned_words(after)
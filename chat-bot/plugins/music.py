@@ -1,6 +1,7 @@
 import asyncio
 import aiohttp
 import os
+import time
 import json
 import functools
 import discord
@@ -9,6 +10,10 @@ import logging
 from sys import platform
 from plugin import plugin
 from decorators import command
+from extractor import AudioInfoCache
+from opus_cache import OpusCache, OpusFilePlayer
+from opus_stream import FFmpegOpusPlayer
+from audio_nodes import AudioNodePool, AUDIO_WORKERS
 from collections import defaultdict
 
 log = logging.getLogger('discord')
@@ -20,23 +25,72 @@ if not discord.opus.is_loaded():
 		discord.opus.load_opus('libopus.dylib')
 
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# A prefetched stream is re-resolved this long before its url expires
+PREFETCH_MARGIN = 300
+BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 2'
+VOLUME = 0.6
+# pcm: discord.py's player, the volume is applied in Python
+# ffmpeg: ffmpeg applies the volume and encodes to Opus
+# passthrough: Opus sources are copied as is, at their own volume
+PLAYBACK_MODE = os.getenv('MUSIC_PLAYBACK', 'ffmpeg')
 
 class Music(Plugin):
 
 	dank_name = "Music"
 	buff_name = "music"
-	players = dict
+	players = {}
 
 	play_locks = defualtdict(asyncio.Lock)
-	call_next = defualtdict(lambda: True)
+
+	def __init__(self, RickBot):
+		super().__init__(RickBot)
+		self.audio_info = AudioInfoCache(RickBot.db, RickBot.loop)
+		self.opus_cache = OpusCache(RickBot.loop, RickBot.stats)
+		# guild id -> resolved stream of the head of the queue
+		self.prefetched = {}
+		self.prefetch_tasks = {}
+		# guild id -> loop time the last player finished at
+		self.finished_at = {}
+		# Playback happens in audio worker processes when there are some
+		self.nodes = None
+		if AUDIO_WORKERS:
+			self.nodes = AudioNodePool(RickBot, self.on_audio_status)
+
+	async def on_shutdown(self):
+		for task in self.prefetch_tasks.values():
+			task.cancel()
+		self.audio_info.close()
+		await self.opus_cache.close()
+		if self.nodes:
+			self.nodes.close()
+
+	def invalidate(self, server_id=None):
+		"""Prefetches again, the website edited the queue"""
+		if server_id is None:
+			guilds = [self.RickBot.get_server(guild_id)
+					  for guild_id in list(self.prefetch_tasks)]
+		else:
+			guilds = [self.RickBot.get_server(server_id)]
+		for guild in guilds:
+			if guild is not None and self.is_playing(guild):
+				self.start_prefetch(guild)
+
+	def is_playing(self, guild):
+		if self.nodes:
+			return self.nodes.is_connected(guild.id)
+		return guild.id in self.players
+
+	def is_connected(self, guild):
+		if self.nodes:
+			return self.nodes.is_connected(guild.id)
+		return guild.voice_client is not None
 
 	@command(pattern='^!play$',
 			 require_one_of_roles="allowed_roles",
 			 description="Makes me play the next song, which is on the queue.",
 			 usage="!play")
 	async def play(self, m, args):
-		voice = m.server.voice_client
-		if not voice:
+		if not self.is_connected(m.server):
 			response = "I am not connected to any voice channels :grimacing:..."
 			return await self.RickBot.send_message(m.channel, response)
 
@@ -57,8 +111,7 @@ class Music(Plugin):
 			 require_one_of_roles="allowed_roles",
 			 usage='!next')
 	async def next(self, m, args):
-		voice = m.server.voice_client
-		if not voice:
+		if not self.is_connected(m.server):
 			response = "I'm not connected to any voice channels :grimacing:..."
 			return await self.RickBot.send_message(m.channel, response)
 
@@ -79,9 +132,14 @@ class Music(Plugin):
 			 require_one_of_roles="allowed_roles",
 			 usage='!stop',)
 	async def stop(self, m, args):
-		curr_player = self.players.get(m.server.id)
+		if self.nodes:
+			if self.nodes.is_connected(m.server.id):
+				self.nodes.stop(m.server.id)
+			return
+
+		# A player that isn't the guild's one anymore doesn't call _next
+		curr_player = self.players.pop(m.server.id, None)
 		if curr_player:
-			self.call_next[m.server.id] = False
 			curr_player.stop()
 
 	async def _next(self, guild):
@@ -89,70 +147,228 @@ class Music(Plugin):
 		if not music:
 			return
 
-		voice = guild.voice_client
-		if not voice:
+		if not self.is_connected(guild):
 			return
 
 		try:
-			await self.play(guild, music)
+			await self._play(guild, music)
 		except Exception as e:
 			response = "An error occurred. Sorry! :cry:"
 			print(e)
 			print(response)
 
-	def sync_next(guild, music):
+	def sync_next(self, guild):
+		loop = self.RickBot.loop
 		def n(player):
+			# Called from the player's thread
 			if player.error:
 				e = player.error
 				import traceback
-				log('Error from the player')
-				log(traceback.format_exception(type(e), e, None))
-			if self.call_next[guild.id]:
-				self.RickBot.loop.create_task(self._next(guild))
-			self.call_next[guild.id] = True
+				log.info('Error from the player')
+				log.info(traceback.format_exception(type(e), e, None))
+			loop.call_soon_threadsafe(self.finished, guild, player)
 		return n
 
-	async def _play(self, guild, music):
-		lock = self.play_locks[guild.id]
-		await lock.acquire()
+	def finished(self, guild, player):
+		# Stopped by !stop or replaced by _play
+		if self.players.get(guild.id) is not player:
+			return
+		self.finished_at[guild.id] = self.RickBot.loop.time()
+		self.RickBot.loop.create_task(self._next(guild))
+
+	async def peek_music(self, guild):
+		storage = await self.get_storage(guild)
+		queue = await storage.lrange('request_queue', 0, 0)
+		if not queue:
+			return None
+		return json.loads(queue[0])
+
+	def start_prefetch(self, guild):
+		task = self.prefetch_tasks.pop(guild.id, None)
+		if task:
+			task.cancel()
+		self.prefetch_tasks[guild.id] = self.RickBot.loop.create_task(
+			self.prefetch(guild)
+		)
+
+	async def prefetch(self, guild):
+		"""Keeps the stream of the head of the queue resolved
+
+		Runs while a track plays, the stream is resolved again shortly
+		before its url expires or when the head of the queue changes. Edits
+		of the queue start it again, see `invalidate`.
+
+		"""
 		try:
-			voice = guild.voice_client
-			opts = {
-				'default_search' : 'auto',
-				'quiet' : True,
-			}
-
-			log("Checking the curr_player")
-			curr_player = self.players.get(guild.id)
-			if curr_player:
-				log(self.players)
-				self.call_next[guild.id] = False
-				log('Stopping the curr_player')
-				curr_player.stop()
-				log('curr_player has been stopped')
+			while True:
+				music = await self.peek_music(guild)
+				if not music:
+					self.prefetched.pop(guild.id, None)
+					if self.nodes:
+						self.nodes.queue(guild.id, None)
+					return
+
+				# Cached songs don't need a stream
+				path = self.opus_cache.path_of(music['url'])
+				if path:
+					self.prefetched.pop(guild.id, None)
+					if self.nodes:
+						self.nodes.queue(guild.id, {'url' : music['url'],
+													'path' : path})
+					return
+
+				prefetched = self.prefetched.get(guild.id)
+				if not self.is_fresh(prefetched, music):
+					prefetched = await self.audio_info.resolve(music['url'])
+					self.prefetched[guild.id] = prefetched
+					# The worker goes on with it as soon as the song ends
+					if self.nodes:
+						self.nodes.queue(guild.id, self.stream_track(prefetched))
+
+				wait = prefetched['expires_at'] - time.time() - PREFETCH_MARGIN
+				await asyncio.sleep(min(max(wait, 30), 600))
+		except asyncio.CancelledError:
+			pass
+		except Exception as e:
+			log.info('Could not prefetch the next song of {}'.format(guild.id))
+			log.info(e)
+			self.prefetched.pop(guild.id, None)
+		finally:
+			if self.prefetch_tasks.get(guild.id) is asyncio.Task.current_task():
+				del self.prefetch_tasks[guild.id]
+
+	def is_fresh(self, prefetched, music):
+		return prefetched is not None and \
+			prefetched['url'] == music['url'] and \
+			prefetched['expires_at'] - time.time() > PREFETCH_MARGIN / 10
+
+	def stream_track(self, stream):
+		passthrough = PLAYBACK_MODE == 'passthrough' and \
+			stream.get('acodec') == 'opus'
+		return {'url' : stream['url'], 'stream_url' : stream['stream_url'],
+				'volume' : VOLUME, 'passthrough' : passthrough}
+
+	async def get_track(self, music, prefetched=None):
+		"""The cached frames of a song, or else its stream"""
+		path = self.opus_cache.lookup(music['url'])
+		if path:
+			return {'url' : music['url'], 'path' : path}
+
+		if not self.is_fresh(prefetched, music):
+			prefetched = await self.audio_info.resolve(music['url'])
+		self.opus_cache.played(music['url'], prefetched['stream_url'],
+							   prefetched['duration'], volume=VOLUME,
+							   before_options=BEFORE_OPTIONS)
+		return self.stream_track(prefetched)
+
+	def create_player(self, voice, track, after):
+		if track.get('path'):
+			return OpusFilePlayer(track['path'], voice, after=after)
+
+		if PLAYBACK_MODE == 'pcm':
+			player = voice.create_ffmpeg_player(track['stream_url'],
+												before_options=BEFORE_OPTIONS,
+												after=after)
+			player.volume = track['volume']
+			return player
+
+		return FFmpegOpusPlayer(voice, track['stream_url'],
+								volume=track['volume'],
+								passthrough=track['passthrough'],
+								before_options=BEFORE_OPTIONS, after=after)
+
+	async def on_audio_status(self, guild_id, message):
+		"""Follows the playback of the guilds handed to audio workers"""
+		guild = self.RickBot.get_server(guild_id)
+		if guild is None:
+			return
 
+		state = message['state']
+		if state == 'playing':
+			# Only set when the worker went on with the queued song
+			if message.get('gap') is None:
+				return
+			self.RickBot.stats.histogram('RickBot.music.track_gap',
+										 message['gap'])
+			music = await self.peek_music(guild)
+			if not music or music['url'] != message['url']:
+				# The queue changed after the worker got its next song
+				log.info('Skipping a stale song in {}'.format(guild.id))
+				if music:
+					await self._next(guild)
+				else:
+					self.nodes.stop(guild.id)
+				return
+			await self.pop_music(guild)
+			prefetched = self.prefetched.pop(guild.id, None)
+			if not self.opus_cache.lookup(music['url']) and \
+					self.is_fresh(prefetched, music):
+				self.opus_cache.played(music['url'],
+									   prefetched['stream_url'],
+									   prefetched['duration'],
+									   volume=VOLUME,
+									   before_options=BEFORE_OPTIONS)
 			await self.set_np(music, guild)
+			self.start_prefetch(guild)
+		elif state in ('finished', 'error'):
+			await self._next(guild)
+		else:
+			task = self.prefetch_tasks.pop(guild.id, None)
+			if task:
+				task.cancel()
+			self.prefetched.pop(guild.id, None)
 
-			log('Creating the player')
-			before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 2'
-			player = await voice.create_ytdl_player(music['url'],
-													ytdl_options=opts,
-													before_options=before_options,
-													after=self.sync_next(guild))
-			log(player)
-			log('Player has been created')
-			self.call_next[guild.id] = True
-			self.players[guild.id] = player
-			player.volume = 0.6
-			log('Starting the new player')
-			player.start()
-			log('Player has been started.')
+	async def _play(self, guild, music):
+		lock = self.play_locks[guild.id]
+		await lock.acquire()
+		try:
+			set_np = self.RickBot.loop.create_task(self.set_np(music, guild))
+
+			prefetched = self.prefetched.pop(guild.id, None)
+			track = await self.get_track(music, prefetched)
+
+			if self.nodes:
+				self.nodes.play(guild.id, track)
+			else:
+				curr_player = self.players.pop(guild.id, None)
+				if curr_player:
+					curr_player.stop()
+
+				player = self.create_player(guild.voice_client, track,
+											self.sync_next(guild))
+				self.players[guild.id] = player
+				player.start()
+
+				finished_at = self.finished_at.pop(guild.id, None)
+				if finished_at is not None:
+					gap = self.RickBot.loop.time() - finished_at
+					self.RickBot.stats.histogram('RickBot.music.track_gap',
+												 gap * 1000)
+
+			self.start_prefetch(guild)
+			await set_np
 		except Exception as e:
-			log('An error has occurred in _play')
-			log(str(e))
+			log.info('An error has occurred in _play')
+			log.info(e)
 		finally:
 			lock.release()
 
+	@command(pattern='^!opuscache$',
+			 user_check=True,
+			 description="Shows the state of the local song cache.",
+			 usage='!opuscache')
+	async def opuscache(self, message, args):
+		info = self.opus_cache.info()
+		response = "**{tracks}** songs in **{files}** files, " \
+				   "**{size:.1f}**/{budget:.0f} MB used\n" \
+				   "Hit rate **{hit_rate:.1%}** ({hits} hits, {misses} misses), " \
+				   "**{encoding}** being encoded".format(
+					   size=info.pop('size') / 1024 / 1024,
+					   budget=info.pop('budget') / 1024 / 1024,
+					   **info
+				   )
+		await self.RickBot.send_message(message.channel, response)
+
 	@command(pattern='^!join',
 			 description="Makes me join the voice channel that you are in.",
 			 require_one_of_roles="allowed_roles",
@@ -164,7 +380,9 @@ class Music(Plugin):
 			return await self.RickBot.send_message(message.channel, response)
 
 		voice = message.server.voice_client
-		if voice:
+		if self.nodes:
+			await self.nodes.connect(voice_channel)
+		elif voice:
 			await voice.move_to(voice_channel)
 		else:
 			await self.RickBot.join(voice_channel)
@@ -177,6 +395,12 @@ class Music(Plugin):
 			 require_one_of_roles="allowed_roles",
 			 usage='!leave')
 	async def leave(self, message, args):
+		if self.nodes:
+			task = self.prefetch_tasks.pop(message.server.id, None)
+			if task:
+				task.cancel()
+			return await self.nodes.disconnect(message.server.id)
+
 		vc = message.server.voice_client
 		log('Trying to leave voice channel, voice_client:')
 		log(vc)
@@ -243,6 +467,10 @@ class Music(Plugin):
 							"avatar" : message.author.avatar_url}
 
 		await self.push_music(music, message.server)
+		# The queue was empty, the new song is the next one
+		if self.is_playing(message.server) and \
+				message.server.id not in self.prefetch_tasks:
+			self.start_prefetch(message.server)
 
 		response = "**{}** has been added! :ok_hand:".format(music["title"])
 		await self.RickBot.send_message(message.channel, response)
@@ -267,20 +495,7 @@ class Music(Plugin):
 			return video_url
 
 	async def get_audio_info(self, url):
-		import youtube_dl
-
-		opts = {
-			'format' : 'webm[abr>0]/bestaudio/best',
-			'prefer_ffmpeg' : True
-		}
-
-		ydl = youtube_dl.YoutubeDL(opts)
-		func = functools.partial(ydl.extract.info, url, download=False)
-		info = await self.RickBot.loop.run_in_executor(None, func)
-		if "entries" in info:
-			info = info['entries'][0]
-
-		return info
+		return await self.audio_info.get(url)
 
 	async def push_music(self, music, guild):
 		storage = await self.get_storage(guild)
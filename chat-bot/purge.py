@@ -0,0 +1,115 @@
+import time
+import asyncio
+import logging
+
+log = logging.getLogger('discord')
+
+DISCORD_EPOCH = 1420070400000
+# Discord refuses to bulk delete messages older than 14 days, keep a margin
+BULK_DELETE_MAX_AGE = 3600 * 24 * 14 - 60
+PAGE_SIZE = 100
+
+
+def snowflake_at(timestamp):
+	"""Smallest snowflake created at a unix timestamp"""
+	return max(int(timestamp * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+class Purger():
+	"""Bulk deletes the recent messages of a channel
+
+	Works on the raw HTTP API: history pages are fetched by 100 and bounded
+	by the snowflake of the bulk delete age limit, which is computed once,
+	and the matching messages are deleted by batches of 100 with at most
+	`concurrency` batches in flight while the next page is fetched.
+
+	"""
+
+	def __init__(self, http, concurrency=2):
+		self.http = http
+		self.concurrency = concurrency
+
+	async def purge(self, channel_id, guild_id, limit=None, check=None,
+					progress=None):
+		"""Deletes up to `limit` messages matching `check`, newest first
+
+		`check` gets the raw message data. Without a limit the whole
+		deletable history is scanned, from the oldest message up, with
+		`after=`. `progress` is awaited with the number of deleted messages
+		after every batch. Returns the number of deleted messages.
+
+		"""
+		cutoff = snowflake_at(time.time() - BULK_DELETE_MAX_AGE)
+		semaphore = asyncio.Semaphore(self.concurrency)
+		deleted = 0
+		tasks = []
+
+		async def delete(ids):
+			nonlocal deleted
+			async with semaphore:
+				if len(ids) == 1:
+					await self.http.delete_message(channel_id, ids[0], guild_id)
+				else:
+					await self.http.delete_messages(channel_id, ids, guild_id)
+			deleted += len(ids)
+			if progress:
+				await progress(deleted)
+
+		batch = []
+		selected = 0
+		async for message in self.history(channel_id, cutoff, limit is None):
+			if check and not check(message):
+				continue
+			batch.append(message['id'])
+			selected += 1
+			if len(batch) == PAGE_SIZE:
+				tasks.append(asyncio.ensure_future(delete(batch)))
+				batch = []
+			if limit is not None and selected >= limit:
+				break
+
+		if batch:
+			tasks.append(asyncio.ensure_future(delete(batch)))
+
+		if tasks:
+			results = await asyncio.gather(*tasks, return_exceptions=True)
+			for result in results:
+				if isinstance(result, Exception):
+					log.info('A purge batch failed in {}'.format(channel_id))
+					log.info(result)
+
+		return deleted
+
+	async def history(self, channel_id, cutoff, forward):
+		"""Yields the messages newer than the cutoff snowflake
+
+		Forward goes from the cutoff up with `after=`, otherwise pages go
+		from the newest message down with `before=` until the cutoff.
+
+		"""
+		if forward:
+			after = cutoff
+			while True:
+				page = await self.http.logs_from(channel_id, PAGE_SIZE,
+												 after=after)
+				if not page:
+					return
+				# Pages are sorted newest first
+				page.sort(key=lambda message: int(message['id']))
+				for message in page:
+					yield message
+				if len(page) < PAGE_SIZE:
+					return
+				after = page[-1]['id']
+		else:
+			before = None
+			while True:
+				page = await self.http.logs_from(channel_id, PAGE_SIZE,
+												 before=before)
+				for message in page:
+					if int(message['id']) < cutoff:
+						return
+					yield message
+				if len(page) < PAGE_SIZE:
+					return
+				before = page[-1]['id']
@@ -1,13 +1,18 @@
 import discord
 import logging
 import os
+import time
 import asyncio
 from plugin_manager import PluginManager
 from database import Db
 from datadog import DDAgent
+from dispatcher import Dispatcher
+from deletion import DeletionScheduler
 
 log = logging.getLogger('discord')
 
+SYNC_CHUNK_SIZE = 500
+
 
 class RickBot(discord.Client):
 	"""A modified discord.Client class
@@ -23,14 +28,28 @@ class RickBot(discord.Client):
 		self.dd_agent_url = kwargs.get('dd_agent_url')
 		self.sentry_dsn = kwargs.get('sentry_dsn')
 		self.db = Db(self.redis_url, self.mongo_url, self.loop)
+		# Plugins get the stats client when they're loaded
+		self.stats = DDAgent(self.dd_agent_url, loop=self.loop)
 		self.plugin_manager = PluginManager(self)
 		self.plugin_manager.load_all()
 		self.last_messages = []
-		self.stats = DDAgent(self.dd_agent_url)
+		self.dispatcher = Dispatcher(self.loop, self.stats)
+		self.deleter = DeletionScheduler(self)
 
 	def run(self, *args):
 		self.loop.run_until_complete(self.start(*args))
 
+	async def close(self):
+		for plugin in self.plugins:
+			try:
+				await plugin.on_shutdown()
+			except Exception as e:
+				log.info('An error occured while shutting down {}'.format(
+					plugin.__class__.__name__
+				))
+				log.info(e)
+		await super().close()
+
 	async def ping(self):
 		PING_INTERVAL = 3
 		key = 'RickBot.gateway.{}-{}'.format(self.shard_id,
@@ -44,6 +63,19 @@ class RickBot(discord.Client):
 
 			await asyncio.sleep(PING_INTERVAL)
 
+	async def monitor_lag(self):
+		"""Measures how late the event loop wakes up a sleeping task"""
+		LAG_INTERVAL = 1
+		LAG_WARNING = 0.25
+		tags = ['shard:{}'.format(self.shard_id)]
+		while True:
+			start = self.loop.time()
+			await asyncio.sleep(LAG_INTERVAL)
+			lag = self.loop.time() - start - LAG_INTERVAL
+			self.stats.histogram('RickBot.loop_lag', lag * 1000, tags=tags)
+			if lag > LAG_WARNING:
+				log.info('Event loop lagging by {:.3f}s'.format(lag))
+
 	async def on_ready(self):
 		"""Called when the bot is ready.
 
@@ -58,24 +90,71 @@ class RickBot(discord.Client):
 			self.loop.create_task(plugin.on_ready())
 
 		self.loop.create_task(self.ping())
+		self.loop.create_task(self.monitor_lag())
+		self.loop.create_task(self.deleter.run())
+		self.loop.create_task(self.plugin_manager.listen_invalidations())
+
+	def is_own_server(self, server_id):
+		"""Whether the server belongs to this shard"""
+		if not self.shard_count:
+			return True
+		return (int(server_id) >> 22) % self.shard_count == self.shard_id
 
 	async def add_all_servers(self):
-		"""Syncing all of the servers to the DB"""
+		"""Syncing all of the servers to the DB
+
+		Only the names and icons that changed are written, with one pipeline
+		per chunk of servers. Servers that this shard left while it was down
+		are removed.
+
+		"""
 		log.info('Syncing servers to the DB')
-		for server in self.servers:
-			self.stats.set('RickBot.servers', server.id)
-			log.debug('Adding server {}\'s id to DB'.format(server.id))
-			await self.db.redis.sadd('servers', server.id)
-			if server.name:
-				await self.db.redis.set(
-					'server:{}:name'.format(server.id),
-					server.icon
-				)
-			if server.icon:
-				await self.db.redis.set(
-					'server:{}:icon'.format(server.id)
-					server.icon
-				)
+		start = time.time()
+		redis = self.db.redis
+		servers = list(self.servers)
+
+		for i in range(0, len(servers), SYNC_CHUNK_SIZE):
+			chunk = servers[i:i + SYNC_CHUNK_SIZE]
+			keys = []
+			values = []
+			for server in chunk:
+				self.stats.set('RickBot.servers', server.id)
+				keys.append('server:{}:name'.format(server.id))
+				values.append(server.name)
+				keys.append('server:{}:icon'.format(server.id))
+				values.append(server.icon)
+
+			stored_values = await redis.mget(*keys)
+			changes = []
+			for key, value, stored_value in zip(keys, values, stored_values):
+				if value and value != stored_value:
+					changes.extend((key, value))
+
+			pipe = redis.pipeline()
+			pipe.sadd('servers', *[server.id for server in chunk])
+			if changes:
+				pipe.mset(*changes)
+			await pipe.execute()
+			log.debug('Synced {} servers, {} changed values'.format(
+				len(chunk),
+				len(changes) // 2
+			))
+
+		server_ids = set(server.id for server in servers)
+		stored_ids = await redis.smembers('servers')
+		gone_ids = [server_id for server_id in stored_ids
+					if server_id not in server_ids and
+					self.is_own_server(server_id)]
+		for i in range(0, len(gone_ids), SYNC_CHUNK_SIZE):
+			await redis.srem('servers', *gone_ids[i:i + SYNC_CHUNK_SIZE])
+
+		duration = time.time() - start
+		self.stats.timing('RickBot.servers_sync', duration * 1000)
+		log.info('Synced {} servers ({} removed) in {:.2f}s'.format(
+			len(servers),
+			len(gone_ids),
+			duration
+		))
 
 	async def on_server_join(self, server):
 		"""Called when joining a new server"""
@@ -96,9 +175,10 @@ class RickBot(discord.Client):
 				server.icon
 			)
 		# Dispatching to the global plugins
-		for plugin in self.plugins:
-			if plugin.is_global:
-				self.loop.create_task(plugin.on_server_join(server))
+		handlers = self.plugin_manager.handlers.get('on_server_join', ())
+		plugins = [plugin for plugin in self.plugins
+				   if plugin.is_global and plugin in handlers]
+		await self.dispatcher.put(server.id, 'on_server_join', plugins, server)
 
 	async def on_server_remove(self, server):
 		"""Called when leaving or upon being kicked/banned from a server
@@ -119,11 +199,16 @@ class RickBot(discord.Client):
 		plugins = await self.plugin_manager.get_all(server)
 		return plugins
 
+	async def dispatch_plugins(self, server, event, *args):
+		"""Queues an event for the enabled plugins handling it"""
+		plugins = await self.plugin_manager.get_interested(server, event)
+		await self.dispatcher.put(server.id, event, plugins, *args)
+
 	async def send_message(self, *args, **kwargs):
 		self.stats.incr('RickBot.sent_messages')
 		return await super().send_message(*args, **kwargs)
 
-	async def on_message(self, *args, **kwargs):
+	async def on_message(self, message):
 		self.stats.incr('RickBot.recv_messages')
 		if message.channel.is_private:
 			return
@@ -139,75 +224,77 @@ class RickBot(discord.Client):
 					"Shard {}/{}".format(self.shard_id, self.shard_count)
 				)
 
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin._on_message(message))
+		await self.dispatch_plugins(server, '_on_message', message)
 
 	async def on_message_edit(self, before, after):
 		if before.channel.is_private:
 			return
 
 		server = after.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_message_edit(before, after))
+		await self.dispatch_plugins(server, 'on_message_edit', before, after)
 
 	async def on_message_delete(self, message):
-		if before.channel.is_private:
+		if message.channel.is_private:
 			return
 
 		server = message.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_message_delete(message))
+		await self.dispatch_plugins(server, 'on_message_delete', message)
 
 	async def on_channel_create(self, channel):
 		if channel.is_private:
 			return
 
 		server = channel.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_channel_create(channel))
+		await self.dispatch_plugins(server, 'on_channel_create', channel)
 
 	async def on_channel_update(self, before, after):
 		if before.is_private:
 			return
 
 		server = after.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_channel_update(before, after))
+		await self.dispatch_plugins(server, 'on_channel_update', before, after)
 
 	async def on_channel_delete(self, channel):
 		if channel.is_private:
 			return
 
 		server = channel.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_channel_delete(channel))
+		await self.dispatch_plugins(server, 'on_channel_delete', channel)
 
 	async def on_member_join(self, member):
 		server = member.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_member_join(member))
+		await self.dispatch_plugins(server, 'on_member_join', member)
 
 	async def on_member_remove(self, member):
 		server = member.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_member_remove(member))
+		await self.dispatch_plugins(server, 'on_member_remove', member)
 
 	async def on_member_update(self, before, after):
 		server = after.server
-		enabled_plugins = await self.get_plugins(server)
-		for plugin in enabled_plugins:
-			self.loop.create_task(plugin.on_member_update(before, after))
+		await self.dispatch_plugins(server, 'on_member_update', before, after)
+
+	async def on_member_ban(self, member):
+		server = member.server
+		await self.dispatch_plugins(server, 'on_member_ban', member)
+
+	async def on_member_unban(self, server, user):
+		await self.dispatch_plugins(server, 'on_member_unban', server, user)
+
+	async def on_server_role_create(self, role):
+		server = role.server
+		await self.dispatch_plugins(server, 'on_server_role_create', server,
+									role)
+
+	async def on_server_role_update(self, before, after):
+		server = after.server
+		await self.dispatch_plugins(server, 'on_server_role_update', server,
+									after)
+
+	async def on_server_role_delete(self, role):
+		server = role.server
+		await self.dispatch_plugins(server, 'on_server_role_delete', server,
+									role)
 
 	async def on_server_update(self, before, after):
 		server = after
-		enabled_plugins = await self.get_plugins(server)
-		for plugins in enabled_plugins:
-			self.loop.create_task(plugin.on_server_update(before, after))
\ No newline at end of file
+		await self.dispatch_plugins(server, 'on_server_update', before, after)
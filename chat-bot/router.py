@@ -0,0 +1,102 @@
+import logging
+
+log = logging.getLogger('discord')
+
+# Characters that end the literal part of a command pattern
+META_CHARS = set('.^$*+?{}[]\\|()')
+QUANTIFIERS = set('*+?{')
+
+
+def literal_prefix(pattern):
+	"""Splits a command pattern into its literal prefix and the rest
+
+	Only the plain characters at the start of the pattern are kept, a
+	character followed by a quantifier is not part of the prefix.
+
+	"""
+	if pattern.startswith('^'):
+		pattern = pattern[1:]
+
+	# A top-level alternation means the prefix isn't mandatory
+	if '|' in pattern:
+		return '', pattern
+
+	i = 0
+	while i < len(pattern) and pattern[i] not in META_CHARS:
+		i += 1
+
+	if i < len(pattern) and pattern[i] in QUANTIFIERS:
+		i = max(i - 1, 0)
+
+	return pattern[:i], pattern[i:]
+
+
+def optional_separator(rest):
+	"""Whether the pattern rest starts with a `\\s` that may match nothing"""
+	if not rest.startswith('\\s'):
+		return False
+	quantifier = rest[2:]
+	return quantifier.startswith(('?', '*', '{0', '{,'))
+
+
+class CommandRouter():
+	"""Finds the commands that may match a message
+
+	Commands starting with a literal `!name` followed by a space, `\\s` or
+	the end of the pattern are indexed by their first token. Other literal
+	prefixes are indexed by their first character and checked with
+	startswith. Commands without any literal prefix, or whose separator
+	after the first token is optional (`\\s?`, `\\s*`), are always tried.
+
+	"""
+
+	def __init__(self, commands=()):
+		self.tokens = {}
+		self.prefixes = {}
+		self.fallback = []
+
+		for command in commands:
+			self.add(command)
+
+	def add(self, command):
+		pattern = getattr(command, '_pattern', None)
+		if not pattern:
+			self.fallback.append(command)
+			return
+
+		prefix, rest = literal_prefix(pattern)
+		if not prefix or prefix[0].isspace() or optional_separator(rest):
+			self.fallback.append(command)
+			return
+
+		token, space, _ = prefix.partition(' ')
+		if space or rest.startswith(('$', '\\s')):
+			self.tokens.setdefault(token, []).append(command)
+		else:
+			self.prefixes.setdefault(prefix[0], []).append((prefix, command))
+
+	def __len__(self):
+		return sum(map(len, self.tokens.values())) + \
+			sum(map(len, self.prefixes.values())) + \
+			len(self.fallback)
+
+	def match(self, content):
+		"""Returns the commands whose pattern may match the content"""
+		if not content:
+			return self.fallback
+
+		candidates = []
+
+		token = content.split(None, 1)
+		if token:
+			candidates.extend(self.tokens.get(token[0], ()))
+
+		prefixes = self.prefixes.get(content[0])
+		if prefixes:
+			candidates.extend(command for prefix, command in prefixes
+							  if content.startswith(prefix))
+
+		if self.fallback:
+			candidates.extend(self.fallback)
+
+		return candidates
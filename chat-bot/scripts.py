@@ -0,0 +1,23 @@
+import hashlib
+import aioredis
+
+
+class Script():
+	"""A Lua script run with EVALSHA
+
+	Falls back to EVAL (which also caches the script server side) when
+	Redis doesn't know the script yet.
+
+	"""
+
+	def __init__(self, source):
+		self.source = source
+		self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+	async def __call__(self, redis, keys=[], args=[]):
+		try:
+			return await redis.evalsha(self.sha, keys=keys, args=args)
+		except aioredis.errors.ReplyError as e:
+			if not str(e).startswith('NOSCRIPT'):
+				raise
+			return await redis.eval(self.source, keys=keys, args=args)
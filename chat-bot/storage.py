@@ -9,12 +9,13 @@ class Storage():
 		self.namespace = namespace
 		self.redis = redis
 
-	async def set(self, key, value, expire = 0):
+	async def set(self, key, value, expire = 0, exist = None):
 		key = self.namespace + key
 		return await self.redis.set(
 			key,
-			value
-			expire = expire
+			value,
+			expire = expire,
+			exist = exist
 		)
 
 	async def get(self, key):
@@ -25,6 +26,10 @@ class Storage():
 		key = self.namespace + key
 		return await self.redis.smembers(key)
 
+	async def run_script(self, script, keys=[], args=[]):
+		keys = [self.namespace + key for key in keys]
+		return await script(self.redis, keys=keys, args=args)
+
 	async def srem(self, key, value):
 		key = self.namespace + key
 		return await self.redis.srem(key, value)
@@ -85,8 +90,9 @@ class Storage():
         key = self.namespace + key
         return await self.redis.lset(key, index, value)
 
-    async def ltrim(self, start, stop):
-        return await self.redis.ltrim(start, stop)
+    async def ltrim(self, key, start, stop):
+        key = self.namespace + key
+        return await self.redis.ltrim(key, start, stop)
 
     async def rpush(self, key, value, *values):
         key = self.namespace + key
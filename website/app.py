@@ -15,6 +15,7 @@ from requests_oauthlib import OAuth2Session
 from flask import Flask, session, request, url_for, render_template, redirect, \
 jsonify, flash, abort, Response
 from itsdangerous import JSONWebSignatureSerializer
+from bson.objectid import ObjectId
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY",
@@ -414,6 +415,16 @@ def plugin_method(f):
 	return my_dash(f)
 
 
+def invalidate_plugins(server_id):
+	"""Tells every shard to drop its cached plugin list for this server"""
+	db.publish('plugins.invalidate', str(server_id))
+
+
+def invalidate_plugin_settings(plugin_name, server_id):
+	"""Tells every shard to drop the settings a plugin cached"""
+	db.publish('plugins.invalidate', '{}:{}'.format(plugin_name, server_id))
+
+
 def plugin_page(plugin_page, buff=None):
 	def decorator(f):
 		@require_auth
@@ -429,16 +440,20 @@ def plugin_page(plugin_page, buff=None):
 				if not buff:
 					db.srem('plugins:{}'.format(server_id), plugins_name)
 					de.srem('plugin.{}.guilds'.format(plugin_name), server_id)
+					invalidate_plugins(server_id)
 					return redirect(url_for('shop', server_id=server_id))
 
 			disable = request.args.get('disable')
 			if disable:
 				db.srem('plugins:{}'.format(server_id), plugin_name)
-				db.srem('plugin:{}.guilds'format(plugin_name), server_id)
+				db.srem('plugin.{}.guilds'.format(plugin_name), server_id)
+				invalidate_plugins(server_id)
 				return redirect(url_for('shop', server_id=server_id))
 
-			db.sadd('plugins.{}'.format(server_id), plugin_name)
 			db.sadd('plugin.{}.guilds'.format(plugin_name), server_id)
+			# Only publish when the set the bot reads changes
+			if db.sadd('plugins:{}'.format(server_id), plugin_name):
+				invalidate_plugins(server_id)
 
 			server = get_guild(server_id)
 			enabled_plugins = db.sismembers('plugins:{}'.format(server_id))
@@ -1322,6 +1337,8 @@ def update_moderator(server_id):
     if mute:
         db.set('Moderator.{}:mute'.format(server_id), '1')
 
+    invalidate_plugin_settings('Moderator', server_id)
+
     flash('Configuration updated ;)!', 'success')
 
     return redirect(url_for('plugin_moderator', server_id=server_id))
@@ -1411,6 +1428,159 @@ def delete_request(server_id, pos):
 		db.delete('Music.{}:request_queue'.format(server_id))
 		for vid in playlist:
 			db.rpush('Music.{}:request_queue'.format(server_id), vid)
+		# The bot may have prefetched the deleted song
+		invalidate_plugin_settings('Music', server_id)
+
+
+"""
+	Logs API
+"""
+
+from rickbot.log_archive import ArchiveReader
+
+LOGS_ARCHIVE_DIR = os.getenv('LOGS_ARCHIVE_DIR', 'logs_archive')
+# The search process, see `python log_search.py serve`
+LOGS_SEARCH_URL = os.getenv('LOGS_SEARCH_URL', 'http://127.0.0.1:5100')
+LOGS_SEARCH_TIMEOUT = 20
+LOGS_PAGE_SIZE = 100
+LOGS_MAX_PAGE_SIZE = 500
+
+
+def get_log_collections(start, end):
+	"""Names of the monthly log collections covering a time range"""
+	date = datetime.datetime.utcfromtimestamp(start)
+	end_date = datetime.datetime.utcfromtimestamp(end)
+	year, month = date.year, date.month
+	collections = []
+	while (year, month) <= (end_date.year, end_date.month):
+		collections.append('messages:{:04}-{:02}'.format(year, month))
+		year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+	return collections
+
+
+@app.route('/api/logs/<int:server_id>')
+def api_logs(server_id):
+	"""Reads the message logs of a time range, one page at a time
+
+	The `cursor` returned with a full page gives the next page.
+
+	"""
+	if 'Logs' not in db.smembers('plugins:{}'.format(server_id)):
+		return jsonify({'error' : 'logs_disabled'}), 404
+
+	now = time.time()
+	start = request.args.get('start', now - 3600 * 24, type=float)
+	end = request.args.get('end', now, type=float)
+	limit = request.args.get('limit', LOGS_PAGE_SIZE, type=int)
+	limit = max(1, min(limit, LOGS_MAX_PAGE_SIZE))
+	channel = request.args.get('channel')
+	cursor = request.args.get('cursor')
+
+	query = {'server' : str(server_id),
+			 'timestamp' : {'$gte' : start, '$lte' : end}}
+	if channel:
+		query['channel'] = channel
+	if cursor:
+		try:
+			cursor_timestamp, cursor_id = cursor.split(':')
+			cursor_timestamp = float(cursor_timestamp)
+			cursor_id = ObjectId(cursor_id)
+		except Exception:
+			return jsonify({'error' : 'invalid_cursor'}), 400
+		start = max(start, cursor_timestamp)
+		query['timestamp']['$gte'] = start
+		query['$or'] = [{'timestamp' : {'$gt' : cursor_timestamp}},
+						{'timestamp' : cursor_timestamp,
+						 '_id' : {'$gt' : cursor_id}}]
+
+	messages = []
+	# Old days live in the archive, the recent ones in Mongo
+	with ArchiveReader(LOGS_ARCHIVE_DIR, server_id) as archive:
+		for message in archive.read_range(start, end, channel):
+			if cursor and (message['timestamp'], message['_id']) <= \
+					(cursor_timestamp, str(cursor_id)):
+				continue
+			messages.append(message)
+			if len(messages) == limit:
+				break
+
+	for collection in get_log_collections(start, end):
+		remaining = limit - len(messages)
+		if remaining <= 0:
+			break
+		found = mongo.logs[collection].find(query)\
+			.sort([('timestamp', 1), ('_id', 1)])\
+			.limit(remaining)
+		messages.extend(found)
+
+	next_cursor = None
+	if len(messages) == limit:
+		last = messages[-1]
+		next_cursor = '{!r}:{}'.format(last['timestamp'], last['_id'])
+	for message in messages:
+		message['_id'] = str(message['_id'])
+
+	return jsonify({'messages' : messages, 'cursor' : next_cursor})
+
+
+# Reads a page of member records in one go, a record pushed between
+# reading the head and the page would shift it. Records ids decrease by
+# one from the head of the list.
+#
+# KEYS: member_logs
+# ARGV: cursor (0 for the first page), limit
+read_member_logs = db.register_script("""
+local start = 0
+local cursor = tonumber(ARGV[1])
+if cursor > 0 then
+	local head = redis.call('LINDEX', KEYS[1], 0)
+	if head then
+		start = math.max(cjson.decode(head)['id'] - cursor + 1, 0)
+	end
+end
+return redis.call('LRANGE', KEYS[1], start, start + tonumber(ARGV[2]) - 1)
+""")
+
+
+@app.route('/api/logs/<int:server_id>/members')
+def api_member_logs(server_id):
+	"""Reads the member events, newest first, one page at a time"""
+	if 'Logs' not in db.smembers('plugins:{}'.format(server_id)):
+		return jsonify({'error' : 'logs_disabled'}), 404
+
+	key = 'Logs.{}:member_logs'.format(server_id)
+	limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+	cursor = request.args.get('cursor', type=int)
+
+	records = [json.loads(record)
+			   for record in read_member_logs(keys=[key],
+											  args=[cursor or 0, limit])]
+	if cursor:
+		records = [record for record in records if record['id'] < cursor]
+
+	next_cursor = records[-1]['id'] if len(records) == limit else None
+	return jsonify({'records' : records, 'cursor' : next_cursor})
+
+
+@app.route('/api/logs/<int:server_id>/search')
+@plugin_method
+def api_logs_search(server_id):
+	"""Searches the logs, e.g. `?q=author:rick hello&page=0`"""
+	query = request.args.get('q', '')
+	page = max(request.args.get('page', 0, type=int), 0)
+	per_page = max(1, min(request.args.get('per_page', 20, type=int), 100))
+
+	# The indexes live in the search process, not in every worker
+	try:
+		r = requests.get(LOGS_SEARCH_URL + '/{}'.format(server_id),
+						 params={'q' : query, 'page' : page,
+								 'per_page' : per_page},
+						 timeout=LOGS_SEARCH_TIMEOUT)
+	except requests.RequestException as e:
+		app.logger.info('Could not reach the search process: {}'.format(e))
+		return jsonify({'error' : 'search_unavailable'}), 503
+
+	return jsonify(r.json()), r.status_code
 
 
 @app.before_first_request